@@ -0,0 +1,369 @@
+"""adminapi - The client for the asyncio programs
+
+Copyright (c) 2017, InnoGames GmbH
+"""
+
+import asyncio
+from collections import defaultdict
+from http.client import HTTPException, RemoteDisconnected
+from io import BytesIO
+import socket
+from ssl import create_default_context
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlparse
+from urllib.request import getproxies, proxy_bypass
+from weakref import WeakKeyDictionary
+
+from adminapi.cmduser import get_auth_token
+from adminapi.dataset import (
+    COMMIT_ENDPOINT,
+    NEW_OBJECT_ENDPOINT,
+    QUERY_ENDPOINT,
+    BaseQuery,
+    DatasetError,
+    _format_obj,
+    _handle_exception,
+)
+from adminapi.request import (
+    REDIRECT_STATUSES,
+    APIError,
+    Settings,
+    build_request,
+    get_retry_interval,
+    is_stale_connection_error,
+    redirect_request,
+)
+from adminapi.schema import SCHEMA_ENDPOINT, cache_schema, get_cached_schema
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+# The connections are bound to the event loops.
+_connection_pools = WeakKeyDictionary()
+
+
+class AsyncQuery(BaseQuery):
+    """Query which doesn't block the event loop
+
+    The results have to be fetched before they can be accessed the same
+    way as the results of the Query:
+
+        query = AsyncQuery({'servertype': 'vm'}, ['hostname'])
+        for server in await query.fetch():
+            ...
+
+    or they can be iterated with "async for".
+    """
+    def __aiter__(self):
+        return _AsyncQueryIterator(self)
+
+    async def fetch(self):
+        if self._results is None:
+            response = await send_request(
+                QUERY_ENDPOINT, post_params=self._get_request_data()
+            )
+            if response['status'] == 'error':
+                _handle_exception(response)
+            schema = await get_schema()
+            self._results = [
+                _format_obj(s, schema) for s in response['result']
+            ]
+        return self._results
+
+    async def new_object(self, servertype):
+        response = await send_request(
+            NEW_OBJECT_ENDPOINT, [('servertype', servertype)]
+        )
+        await self.fetch()
+        return self._add_new_object(
+            _format_obj(response['result'], await get_schema())
+        )
+
+    async def commit(self):
+        commit = self._build_commit_object()
+        result = await send_request(COMMIT_ENDPOINT, post_params=commit)
+
+        if result['status'] == 'error':
+            _handle_exception(result)
+
+        for obj in self:
+            obj._confirm_changes()
+
+    def _fetch_results(self):
+        raise DatasetError('The results are not fetched yet')
+
+
+class _AsyncQueryIterator(object):
+    """Fetch the results of the query on the first iteration
+
+    This is not an asynchronous generator to work on Python 3.5.
+    """
+    def __init__(self, query):
+        self._query = query
+        self._results = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._results is None:
+            self._results = iter(await self._query.fetch())
+        try:
+            return next(self._results)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class ConnectionPool(object):
+    """Keep the connections open to reuse them for the next requests
+
+    The connections of a pool must only be used in the same event loop.
+    The idle connections may be closed by the server anytime, so
+    the requests are sent again on a new connection, if the idle one turns
+    out to be closed before anything is received, like the ones of
+    adminapi.request.ConnectionPool.  The errors before the request is
+    sent are raised as URLError.
+    """
+    def __init__(self):
+        self._idle = defaultdict(list)
+
+    async def request(self, request):
+        """Send the request and return the status, reason, headers and body"""
+        key = request.type, request.host
+        if self._idle[key]:
+            try:
+                return await self._send(key, self._idle[key].pop(), request)
+            except (HTTPException, OSError) as error:
+                if not is_stale_connection_error(error):
+                    raise
+
+        return await self._send(key, await self._connect(*key), request)
+
+    async def _connect(self, scheme, netloc):
+        url = urlparse('//' + netloc)
+        port = url.port or (443 if scheme == 'https' else 80)
+        ssl = create_default_context() if scheme == 'https' else None
+        proxy = getproxies().get(scheme)
+        try:
+            if proxy and not proxy_bypass(netloc):
+                sock = await asyncio.wait_for(
+                    _open_tunnel(urlparse(proxy), url.hostname, port),
+                    Settings.timeout,
+                )
+                return await asyncio.wait_for(asyncio.open_connection(
+                    sock=sock,
+                    ssl=ssl,
+                    server_hostname=url.hostname if ssl else None,
+                ), Settings.timeout)
+            return await asyncio.wait_for(
+                asyncio.open_connection(url.hostname, port, ssl=ssl),
+                Settings.timeout,
+            )
+        except (OSError, asyncio.TimeoutError) as error:
+            raise URLError(error)
+
+    async def _send(self, key, connection, request):
+        reader, writer = connection
+        try:
+            try:
+                writer.write(_format_request(request))
+                await asyncio.wait_for(writer.drain(), Settings.timeout)
+            except (OSError, asyncio.TimeoutError) as error:
+                raise URLError(error)
+            status_line = await asyncio.wait_for(
+                reader.readline(), Settings.timeout
+            )
+            if not status_line:
+                raise RemoteDisconnected(
+                    'Remote end closed connection without response'
+                )
+            try:
+                status, reason, headers, body, keep_alive = (
+                    await asyncio.wait_for(
+                        _read_response(reader, status_line), Settings.timeout
+                    )
+                )
+            except ConnectionError as error:
+                # The server may have already executed the request.
+                raise HTTPException(error)
+        except BaseException:
+            # The connection cannot be used after an incomplete response,
+            # including the cancelled ones.
+            writer.close()
+            raise
+
+        if keep_alive and len(self._idle[key]) < Settings.idle_connections:
+            self._idle[key].append(connection)
+        else:
+            writer.close()
+
+        return status, reason, headers, body
+
+
+async def get_schema():
+    """Return the schema of the server like adminapi.schema.get_schema()"""
+    schema = get_cached_schema()
+    if schema is None:
+        try:
+            response = await send_request(SCHEMA_ENDPOINT)
+        except HTTPError as error:
+            if error.code != 404:
+                raise
+            response = None
+        schema = cache_schema(response)
+    return schema
+
+
+async def send_request(endpoint, get_params=None, post_params=None):
+    if not Settings.auth_token:
+        Settings.auth_token = get_auth_token()
+
+    request = build_request(
+        endpoint, Settings.auth_token, get_params, post_params
+    )
+    for redirect in range(Settings.max_redirects + 1):
+        status, reason, headers, body = await _retry_request(request)
+        if status not in REDIRECT_STATUSES:
+            return json.loads(body.decode())
+        if redirect == Settings.max_redirects:
+            raise HTTPError(
+                request.get_full_url(),
+                status,
+                'Too many redirects',
+                headers,
+                BytesIO(body),
+            )
+        request = redirect_request(request, status, headers['location'])
+
+
+async def _retry_request(request):
+    for attempt in range(Settings.tries):
+        response = await _try_request(request, attempt + 1 < Settings.tries)
+        if response is not None:
+            return response
+
+        # In case of an error, sleep before trying again
+        await asyncio.sleep(get_retry_interval(attempt))
+
+    assert False    # Cannot happen
+
+
+async def _try_request(request, retry=False):
+    loop = asyncio.get_event_loop()
+    if loop not in _connection_pools:
+        _connection_pools[loop] = ConnectionPool()
+    try:
+        status, reason, headers, body = (
+            await _connection_pools[loop].request(request)
+        )
+    except URLError:
+        if retry:
+            return None
+        raise
+
+    if status < 300:
+        return status, reason, headers, body
+    if status in REDIRECT_STATUSES and 'location' in headers:
+        return status, reason, headers, body
+    if status >= 500:
+        if retry:
+            return None
+    elif headers.get('content-type') == 'application/x-json':
+        payload = json.loads(body.decode())
+        message = payload['error']['message']
+        raise APIError(message, status_code=status)
+    raise HTTPError(
+        request.get_full_url(), status, reason, headers, BytesIO(body)
+    )
+
+
+def _format_request(request):
+    headers = dict(request.header_items())
+    headers['Host'] = request.host
+    if request.data is not None:
+        headers['Content-Length'] = str(len(request.data))
+    lines = ['{} {} HTTP/1.1'.format(request.get_method(), request.selector)]
+    lines.extend('{}: {}'.format(k, v) for k, v in headers.items())
+    head = '\r\n'.join(lines) + '\r\n\r\n'
+    return head.encode('latin-1') + (request.data or b'')
+
+
+async def _open_tunnel(proxy, host, port):
+    """Return the socket connected through the proxy to the server"""
+    loop = asyncio.get_event_loop()
+    family, type_, proto, _, address = (await loop.getaddrinfo(
+        proxy.hostname, proxy.port or 80, type=socket.SOCK_STREAM
+    ))[0]
+    sock = socket.socket(family, type_, proto)
+    sock.setblocking(False)
+    try:
+        await loop.sock_connect(sock, address)
+        await loop.sock_sendall(sock, (
+            'CONNECT {0}:{1} HTTP/1.0\r\nHost: {0}:{1}\r\n\r\n'
+            .format(host, port).encode('latin-1')
+        ))
+        # The proxy doesn't send anything else until the tunnel is used.
+        head = b''
+        while b'\r\n\r\n' not in head:
+            data = await loop.sock_recv(sock, 4096)
+            if not data:
+                raise OSError('Proxy closed the connection')
+            head += data
+        status_line = head.split(b'\r\n', 1)[0].decode('latin-1')
+        if status_line.split(' ', 2)[1:2] != ['200']:
+            raise OSError('Tunnel connection failed: ' + status_line)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
+
+
+async def _read_response(reader, status_line):
+    version, status, reason = (
+        status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + ['']
+    )[:3]
+    if not status.isdigit():
+        raise HTTPException('Invalid status line: {!r}'.format(status_line))
+    status = int(status)
+
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    keep_alive = (
+        version == 'HTTP/1.1' and
+        headers.get('connection', '').lower() != 'close'
+    )
+    if status in (204, 304) or 100 <= status < 200:
+        body = b''
+    elif headers.get('transfer-encoding', '').lower() == 'chunked':
+        body = await _read_chunks(reader)
+    elif 'content-length' in headers:
+        body = await reader.readexactly(int(headers['content-length']))
+    else:
+        body = await reader.read()
+        keep_alive = False
+
+    return status, reason, headers, body, keep_alive
+
+
+async def _read_chunks(reader):
+    chunks = []
+    while True:
+        size = int((await reader.readline()).split(b';')[0], 16)
+        if not size:
+            break
+        chunks.append(await reader.readexactly(size))
+        await reader.readexactly(2)
+
+    # Skip the trailers
+    while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+        pass
+
+    return b''.join(chunks)
@@ -27,6 +27,12 @@ def parse_args():
         action='append',
         help='Attributes to fetch (default: "hostname")' + multi_note,
     )
+    parser.add_argument(
+        '-c',
+        '--cache-ttl',
+        type=int,
+        help='Seconds to use the results from the cache directory',
+    )
     parser.add_argument(
         '-o',
         '--order',
@@ -62,7 +68,14 @@ def main():
 
     # TODO: Avoid .join()
     filters = parse_query(' '.join(args.query))
-    query = Query(filters, attribute_ids_to_fetch, args.order)
+    # The changes have to be made on the current data.
+    if args.reset or args.update:
+        cache_ttl = None
+    else:
+        cache_ttl = args.cache_ttl
+    query = Query(
+        filters, attribute_ids_to_fetch, args.order, cache_ttl=cache_ttl
+    )
 
     if args.one and len(query) > 1:
         raise Exception(
@@ -1,18 +1,39 @@
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from collections import OrderedDict
 from distutils.util import strtobool
 from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network
 from itertools import chain
+from threading import Lock, local
 from types import GeneratorType
 
 from adminapi.datatype import validate_value, json_to_datatype
 from adminapi.filters import Any, BaseFilter, ContainedOnlyBy
-from adminapi.request import send_request
+from adminapi.request import HTTPError, send_request, stream_request
+from adminapi.schema import get_schema, get_type_converter
 
 NEW_OBJECT_ENDPOINT = '/dataset/new_object'
 COMMIT_ENDPOINT = '/dataset/commit'
 QUERY_ENDPOINT = '/dataset/query'
+MULTI_QUERY_ENDPOINT = '/dataset/multi_query'
+EXPLAIN_ENDPOINT = '/dataset/explain'
+CHANGES_ENDPOINT = '/dataset/changes'
+WATCH_ENDPOINT = '/dataset/watch'
 CREATE_ENDPOINT = '/dataset/create'
 
 
+# The stack of the active batches of the thread
+_batches = local()
+
+# The positions of the attributes by their ids for the frozen objects,
+# the least recently used ones are dropped after the maximum
+MAX_POSITIONS = 256
+_positions = OrderedDict()
+_positions_lock = Lock()
+
+
 class DatasetError(Exception):
     pass
 
@@ -28,11 +49,21 @@ class BaseQuery(object):
                 for a, f in filters.items()
             }
             self._results = None
+        # The iterator of the results which are still being fetched
+        self._pending = None
         self._restrict = restrict
         self._order_by = order_by
 
     def __iter__(self):
-        return iter(self._get_results())
+        if self._results is None:
+            pending = self._fetch_results()
+            # The results may have been fetched all at once.
+            if self._results is None:
+                self._results = []
+                self._pending = pending
+        if self._pending is None:
+            return iter(self._results)
+        return self._iter_results()
 
     def __len__(self):
         return len(self._get_results())
@@ -53,8 +84,45 @@ class BaseQuery(object):
     def _get_results(self):
         if self._results is None:
             self._results = list(self._fetch_results())
+        while self._pending is not None:
+            self._fetch_next()
         return self._results
 
+    def _iter_results(self):
+        """Iterate the results while they are being fetched
+
+        The results are appended to the list as soon as they are fetched,
+        so the iterations and the other accesses in the meantime share
+        the same objects.
+        """
+        position = 0
+        while position < len(self._results) or self._pending is not None:
+            if position < len(self._results):
+                yield self._results[position]
+                position += 1
+            else:
+                self._fetch_next()
+
+    def _fetch_next(self):
+        try:
+            obj = next(self._pending)
+        except StopIteration:
+            self._pending = None
+        except BaseException:
+            # The results are fetched again next time.
+            self._results = self._pending = None
+            raise
+        else:
+            self._results.append(obj)
+
+    def _get_request_data(self):
+        request_data = {'filters': self._filters}
+        if self._restrict is not None:
+            request_data['restrict'] = self._restrict
+        if self._order_by is not None:
+            request_data['order_by'] = self._order_by
+        return request_data
+
     def _fetch_results(self):
         raise NotImplementedError()
 
@@ -62,9 +130,11 @@ class BaseQuery(object):
         raise NotImplementedError()
 
     def new_object(self, servertype):
-        obj = self._fetch_new_object(servertype)
+        return self._add_new_object(self._fetch_new_object(servertype))
+
+    def _add_new_object(self, obj):
         if self._filters:
-            for attribute, filt in self._filters:
+            for attribute, filt in self._filters.items():
                 if attribute not in obj:
                     raise DatasetError(
                         '"{}" is not on the new object'.format(attribute)
@@ -196,14 +266,46 @@ class BaseQuery(object):
 
 
 class Query(BaseQuery):
+    def __init__(
+        self,
+        filters=None,
+        restrict=None,
+        order_by=None,
+        page_size=None,
+        cache_ttl=None,
+        read_only=False,
+        columns=False,
+    ):
+        super(Query, self).__init__(filters, restrict, order_by)
+        self._page_size = page_size
+        self._cache_ttl = cache_ttl
+        self._read_only = read_only
+        self._columns = columns
+        self._commit_id = None
+        self._last_commit_id = None
+        self._batch = None
+        # The queries with a cache TTL are left to the cache.
+        batches = getattr(_batches, 'stack', None)
+        if (
+            batches and
+            self._results is None and
+            page_size is None and
+            cache_ttl is None
+        ):
+            self._batch = batches[-1]
+            self._batch.add(self)
 
     def _fetch_new_object(self, servertype):
+        if self._read_only:
+            raise DatasetError('Cannot create objects on read-only query')
         response = send_request(
             NEW_OBJECT_ENDPOINT, [('servertype', servertype)]
         )
-        return _format_obj(response['result'])
+        return _format_obj(response['result'], get_schema())
 
     def commit(self):
+        if self._read_only:
+            raise DatasetError('Cannot commit read-only query')
         commit = self._build_commit_object()
         result = send_request(COMMIT_ENDPOINT, post_params=commit)
 
@@ -214,17 +316,227 @@ class Query(BaseQuery):
         for obj in self:
             obj._confirm_changes()
 
+    def explain(self):
+        """Return the SQL, the plan and the timings of the query
+
+        The query is executed on the server to measure them.
+        """
+        response = send_request(
+            EXPLAIN_ENDPOINT, post_params=self._get_request_data()
+        )
+        if response['status'] == 'error':
+            _handle_exception(response)
+        return response['result']
+
+    def sync(self):
+        """Apply the changes committed since the last synchronization
+
+        The first call fetches all of the objects, the next ones only
+        the objects changed in the meantime, so the cost depends on
+        the number of changes rather than the number of objects.
+        The changed objects are replaced, the new ones are appended to
+        the results.  Returns the created, changed and deleted objects.
+        """
+        if self._commit_id is None:
+            return self._apply_changes(CHANGES_ENDPOINT, None)
+        return self._apply_changes(
+            CHANGES_ENDPOINT, [('since', self._commit_id)]
+        )
+
+    def watch(self, timeout=30):
+        """Synchronize the results whenever they are changed
+
+        The server is asked to wait for the commits changing any of
+        the attributes the query depends on.  Yields the created, changed
+        and deleted objects like sync() for every change, forever.
+        """
+        if self._commit_id is None:
+            self.sync()
+        while True:
+            changes = self._apply_changes(WATCH_ENDPOINT, [
+                ('since', self._commit_id),
+                ('seen', self._last_commit_id),
+                ('timeout', timeout),
+            ])
+            if changes.created or changes.changed or changes.deleted:
+                yield changes
+
+    def _apply_changes(self, endpoint, get_params):
+        # Only the objects fetched so far can be changed.
+        if any(o.is_dirty() for o in self._results or ()):
+            raise DatasetError('Cannot synchronize uncommitted changes')
+
+        request_data = self._get_request_data()
+        request_data.pop('order_by', None)
+        schema = get_schema()
+        objects = []
+        for document in stream_request(endpoint, get_params, request_data):
+            if 'object_id' in document:
+                objects.append(
+                    _format_obj(document, schema, self._read_only)
+                )
+                continue
+            if document['status'] == 'error':
+                _handle_exception(document)
+            break
+        else:
+            raise DatasetError('Incomplete response')
+
+        results = self._results or []
+        positions = {o['object_id']: i for i, o in enumerate(results)}
+        if self._commit_id is None:
+            # All of the objects are returned on the first call.
+            deleted_ids = set(positions) - {o['object_id'] for o in objects}
+        else:
+            deleted_ids = set(document['deleted'])
+
+        created = []
+        changed = []
+        for obj in objects:
+            position = positions.get(obj['object_id'])
+            if position is None:
+                results.append(obj)
+                created.append(obj)
+            elif results[position] != obj:
+                results[position] = obj
+                changed.append(obj)
+        deleted = [o for o in results if o['object_id'] in deleted_ids]
+
+        self._results = [
+            o for o in results if o['object_id'] not in deleted_ids
+        ]
+        self._pending = None
+        self._commit_id = document['commit_id']
+        self._last_commit_id = document['last_commit_id']
+
+        return DatasetCommit(created, changed, deleted)
+
     def _fetch_results(self):
-        request_data = {'filters': self._filters}
-        if self._restrict is not None:
-            request_data['restrict'] = self._restrict
-        if self._order_by is not None:
-            request_data['order_by'] = self._order_by
+        if self._batch is not None:
+            self._batch.fetch()
+            if self._results is not None:
+                return iter(self._results)
+
+        request_data = self._get_request_data()
+        if self._page_size is not None:
+            return self._fetch_pages(request_data)
+        return self._fetch_stream(request_data)
+
+    def _fetch_stream(self, request_data):
+        request_data['stream'] = True
+        # The columns are not taken from the result cache of the server.
+        if self._columns:
+            request_data['format'] = 'columns'
+        documents = stream_request(
+            QUERY_ENDPOINT, post_params=request_data, cache_ttl=self._cache_ttl
+        )
+        column_sets = []
+        schema = None
+        for document in documents:
+            # The servers are sent as rows of the column sets, if
+            # the server supports it, otherwise as objects.
+            if isinstance(document, list):
+                yield _format_row(
+                    column_sets[document[0]], document[1:], self._read_only
+                )
+                continue
+            if 'columns' in document:
+                column_sets.append((
+                    document['columns'],
+                    [get_type_converter(t) for t in document['types']],
+                    _get_positions(document['columns']),
+                ))
+                continue
 
-        response = send_request(QUERY_ENDPOINT, post_params=request_data)
+            # The servers are followed by a status document on the streamed
+            # responses.  The older servers would return a single document
+            # with the status and the servers.
+            # The schema is only needed for the objects.
+            if schema is None:
+                schema = get_schema()
+            if 'object_id' in document:
+                yield _format_obj(document, schema, self._read_only)
+                continue
+            if document['status'] == 'error':
+                _handle_exception(document)
+            for server in document.get('result', []):
+                yield _format_obj(server, schema, self._read_only)
+            break
+        else:
+            raise DatasetError('Incomplete response')
+
+    def _fetch_pages(self, request_data):
+        request_data['page_size'] = self._page_size
+        schema = get_schema()
+        while True:
+            response = send_request(QUERY_ENDPOINT, post_params=request_data)
+            if response['status'] == 'error':
+                _handle_exception(response)
+            for server in response['result']:
+                yield _format_obj(server, schema, self._read_only)
+
+            # The older servers would return all results without a cursor.
+            if not response.get('cursor'):
+                break
+            request_data['cursor'] = response['cursor']
+
+
+class QueryBatch(object):
+    """Fetch the results of the queries created in the context together
+
+    The queries are fetched in a single request when the results of any
+    of them are first needed:
+
+        with QueryBatch():
+            web = Query({'game_function': 'web'})
+            db = Query({'game_function': 'db'})
+        for server in chain(web, db):
+            ...
+
+    The queries with errors are fetched again alone to raise them.  So are
+    all of the queries, if the server doesn't support fetching them
+    together.
+    """
+    def __init__(self):
+        self._queries = []
+
+    def __enter__(self):
+        if not hasattr(_batches, 'stack'):
+            _batches.stack = []
+        _batches.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _batches.stack.remove(self)
+
+    def add(self, query):
+        self._queries.append(query)
+
+    def fetch(self):
+        queries = [q for q in self._queries if q._results is None]
+        self._queries = []
+        if not queries:
+            return
+
+        for query in queries:
+            query._batch = None
+        try:
+            response = send_request(MULTI_QUERY_ENDPOINT, post_params={
+                'queries': [q._get_request_data() for q in queries],
+            })
+        except HTTPError as error:
+            if error.code != 404:
+                raise
+            return
         if response['status'] == 'error':
             _handle_exception(response)
-        return (_format_obj(s) for s in response['result'])
+        schema = get_schema()
+        for query, result in zip(queries, response['results']):
+            if result['status'] == 'success':
+                query._results = [
+                    _format_obj(s, schema, query._read_only)
+                    for s in result['result']
+                ]
 
 
 class DatasetObject(dict):
@@ -416,15 +728,58 @@ class DatasetObject(dict):
         self._confirm_changes()
 
 
+class FrozenObject(Mapping):
+    """Read-only object with the dictionary access to the attributes
+
+    The values are kept in a tuple.  The positions of the attributes in it
+    are shared by the objects with the same attributes, so the objects take
+    a lot less memory than the DatasetObjects.  The multi attributes are
+    frozensets.
+    """
+    __slots__ = ('_positions', '_values')
+
+    def __init__(self, positions, values):
+        self._positions = positions
+        self._values = values
+
+    def __getitem__(self, attribute_id):
+        return self._values[self._positions[attribute_id]]
+
+    def __iter__(self):
+        return iter(self._positions)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def __hash__(self):
+        return self.object_id
+
+    def __repr__(self):
+        return 'FrozenObject({0}, {1})'.format(dict(self), self.object_id)
+
+    @property
+    def object_id(self):
+        return self['object_id']
+
+    def is_dirty(self):
+        return False
+
+
 class MultiAttr(set):
     """This class must redefine all mutable methods of the set class
     to maintain the old values on the DatasetObject.
+
+    The set is changed in place, so adding or removing an element doesn't
+    copy the whole set.  The old value is saved on the first change only,
+    and only the new elements are validated against the datatype of
+    the attribute which is cached after it is first found.
     """
 
     def __init__(self, other, obj, attribute_id):
         super(MultiAttr, self).__init__(other)
         self._obj = obj
         self._attribute_id = attribute_id
+        self._datatype = None
 
     def __str__(self):
         return ' '.join(str(x) for x in self)
@@ -433,47 +788,83 @@ class MultiAttr(set):
         return MultiAttr(self, self._obj, self._attribute_id)
 
     def add(self, elem):
-        self._obj[self._attribute_id] = self | {elem}
+        if elem not in self:
+            self._prepare_change((elem, ))
+            super(MultiAttr, self).add(elem)
 
     def discard(self, elem):
-        self._obj[self._attribute_id] = self - {elem}
+        if elem in self:
+            self._prepare_change()
+            super(MultiAttr, self).discard(elem)
 
     def remove(self, elem):
         if elem not in self:
-            raise KeyError()
+            raise KeyError(elem)
         self.discard(elem)
 
     def pop(self):
         for elem in self:
             break
         else:
-            raise KeyError()
+            raise KeyError('pop from an empty set')
         self.discard(elem)
         return elem
 
     def clear(self):
-        self._obj[self._attribute_id] = set()
+        if self:
+            self._prepare_change()
+            super(MultiAttr, self).clear()
 
     def update(self, *others):
-        new = set(self)
-        for other in others:
-            new |= other
-        self._obj[self._attribute_id] = new
+        new = {e for o in others for e in o if e not in self}
+        if new:
+            self._prepare_change(new)
+            super(MultiAttr, self).update(new)
 
     def intersection_update(self, *others):
-        new = set(self)
+        kept = set(self)
         for other in others:
-            new &= other
-        self._obj[self._attribute_id] = new
+            kept.intersection_update(other)
+        self.difference_update(self - kept)
 
     def difference_update(self, *others):
-        new = set(self)
-        for other in others:
-            new -= other
-        self._obj[self._attribute_id] = new
+        removed = {e for o in others for e in o if e in self}
+        if removed:
+            self._prepare_change()
+            super(MultiAttr, self).difference_update(removed)
 
     def symmetric_difference_update(self, other):
-        self._obj[self._attribute_id] = self ^ other
+        other = set(other)
+        new = other - self
+        if new:
+            self._prepare_change(new)
+        elif other & self:
+            self._prepare_change()
+        super(MultiAttr, self).symmetric_difference_update(other)
+
+    def _prepare_change(self, new=()):
+        """Validate the new elements and save the old value if necessary
+
+        This has to be called before the set is changed, so that nothing
+        is changed, if anything fails.
+        """
+        if self._obj._deleted:
+            raise DatasetError('Cannot set attributes to deleted object')
+
+        datatype = self._get_datatype()
+        for elem in new:
+            datatype = validate_value(elem, datatype)
+        self._obj._save_old_value(self._attribute_id)
+        self._datatype = datatype
+
+    def _get_datatype(self):
+        # The datatype is checked against the old value as well, like
+        # DatasetObject.validate() does when the whole set is replaced.
+        if self._datatype is None:
+            old_value = self._obj.old_values.get(self._attribute_id, ())
+            for elem in chain(old_value, self):
+                self._datatype = validate_value(elem, self._datatype)
+        return self._datatype
 
 
 class DatasetCommit(object):
@@ -515,28 +906,102 @@ def create(attributes):
     if response['status'] == 'error':
         _handle_exception(response)
 
-    return _format_obj(response['result'][0])
+    return _format_obj(response['result'][0], get_schema())
 
 
-def _format_obj(result):
+def _format_obj(result, schema=None, read_only=False):
+    """Build the object from the result
+
+    The values are converted by the schema, if it is given, otherwise
+    their datatypes are guessed from their formats.
+    """
+    if read_only:
+        return _freeze_obj(result, schema)
+
     obj = DatasetObject([('object_id', result.pop('object_id'))])
 
     for attribute_id, value in list(result.items()):
+        if schema is None:
+            convert = json_to_datatype
+        else:
+            convert = schema.get_converter(attribute_id)
+
         if isinstance(value, list):
             casted_value = MultiAttr(
-                (_format_attribute_value(v) for v in value),
+                (_format_attribute_value(v, convert, schema) for v in value),
                 obj,
                 attribute_id,
             )
         else:
-            casted_value = _format_attribute_value(value)
+            casted_value = _format_attribute_value(value, convert, schema)
+
+        dict.__setitem__(obj, attribute_id, casted_value)
+
+    return obj
+
+
+def _freeze_obj(result, schema):
+    values = []
+    for attribute_id, value in result.items():
+        if schema is None:
+            convert = json_to_datatype
+        else:
+            convert = schema.get_converter(attribute_id)
+
+        if isinstance(value, list):
+            values.append(frozenset(
+                _freeze_attribute_value(v, convert, schema) for v in value
+            ))
+        else:
+            values.append(_freeze_attribute_value(value, convert, schema))
+
+    return FrozenObject(_get_positions(result.keys()), tuple(values))
+
+
+def _format_row(column_set, row, read_only=False):
+    attribute_ids, converters, positions = column_set
+    if read_only:
+        return FrozenObject(positions, tuple(
+            frozenset(convert(v) for v in value)
+            if isinstance(value, list) else convert(value)
+            for convert, value in zip(converters, row)
+        ))
+
+    obj = DatasetObject([('object_id', row[attribute_ids.index('object_id')])])
+
+    for attribute_id, convert, value in zip(attribute_ids, converters, row):
+        if isinstance(value, list):
+            casted_value = MultiAttr(
+                (convert(v) for v in value), obj, attribute_id
+            )
+        else:
+            casted_value = convert(value)
 
         dict.__setitem__(obj, attribute_id, casted_value)
 
     return obj
 
 
-def _format_attribute_value(value):
+def _get_positions(attribute_ids):
+    """Return the positions of the attributes shared by the objects"""
+    attribute_ids = tuple(attribute_ids)
+    with _positions_lock:
+        positions = _positions.pop(attribute_ids, None)
+        if positions is None:
+            positions = {a: i for i, a in enumerate(attribute_ids)}
+            while len(_positions) >= MAX_POSITIONS:
+                _positions.popitem(last=False)
+        _positions[attribute_ids] = positions
+    return positions
+
+
+def _format_attribute_value(value, convert, schema):
+    if isinstance(value, dict):
+        return _format_obj(value, schema)
+    return convert(value)
+
+
+def _freeze_attribute_value(value, convert, schema):
     if isinstance(value, dict):
-        return _format_obj(value)
-    return json_to_datatype(value)
+        return _freeze_obj(value, schema)
+    return convert(value)
@@ -1,6 +1,13 @@
 from datetime import date
 from re import compile as re_compile
-from ipaddress import IPv4Address, IPv4Network, IPv6Address, IPv6Network
+from ipaddress import (
+    IPv4Address,
+    IPv4Network,
+    IPv6Address,
+    IPv6Network,
+    ip_address,
+    ip_network,
+)
 
 from netaddr import EUI, mac_unix
 
@@ -122,3 +129,19 @@ def json_to_datatype(value):
                 return EUI(value, dialect=mac_unix)
             return datatype(value)
     return value
+
+
+def _decode_inet(value):
+    if '/' in value:
+        return ip_network(value)
+    return ip_address(value)
+
+
+# The decoders of the values by the attribute types of the server.  They
+# give the same datatypes as json_to_datatype() for the values of these
+# types.  The values of the other types are used as they are.
+TYPE_DECODERS = {
+    'inet': _decode_inet,
+    'macaddr': lambda v: EUI(v, dialect=mac_unix),
+    'date': lambda v: date(*(int(d) for d in v.split('-', 2))),
+}
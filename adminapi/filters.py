@@ -19,15 +19,10 @@ class BaseFilter(object):
             pass
         elif isinstance(value, (int, float)):
             pass
-        elif isinstance(value, tuple(s[0] for s in STR_BASED_DATATYPES)):
+        elif isinstance(value, STR_DATATYPES + tuple(
+            s[0] for s in STR_BASED_DATATYPES
+        )):
             pass
-        elif isinstance(value, STR_DATATYPES):
-            for char in '\'"':
-                if char in value:
-                    raise FilterValueError(
-                        '"{}" character is not allowed on filter values'
-                        .format(char)
-                    )
         else:
             raise FilterValueError(
                 'Filter value cannot be {}'.format(type(value).__name__)
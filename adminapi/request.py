@@ -1,25 +1,64 @@
+from errno import ECONNRESET, EPIPE
 import os
+from collections import OrderedDict, defaultdict
+from functools import partial
 from hashlib import sha1
 import hmac
+from io import BytesIO
+from random import uniform
+from socket import error as SocketError
 from ssl import SSLError
+from tempfile import NamedTemporaryFile
+from threading import Lock
 import time
 
 from adminapi.cmduser import get_auth_token
 from adminapi.filters import BaseFilter
 
 try:
+    from http.client import (
+        BadStatusLine,
+        HTTPConnection,
+        HTTPSConnection,
+        HTTPException,
+    )
     from urllib.error import HTTPError, URLError
-    from urllib.parse import urlencode
-    from urllib.request import urlopen, Request
+    from urllib.parse import urlencode, urljoin, urlparse
+    from urllib.request import Request, getproxies, proxy_bypass
 except ImportError:
-    from urllib import urlencode
-    from urllib2 import urlopen, Request, HTTPError, URLError
+    from httplib import (
+        BadStatusLine,
+        HTTPConnection,
+        HTTPSConnection,
+        HTTPException,
+    )
+    from urllib import urlencode, getproxies, proxy_bypass
+    from urllib2 import Request, HTTPError, URLError
+    from urlparse import urljoin, urlparse
 
 try:
     import simplejson as json
 except ImportError:
     import json
 
+try:
+    from fcntl import LOCK_EX, flock
+except ImportError:
+    flock = None
+
+try:
+    from os import replace as replace_file
+except ImportError:
+    from os import rename as replace_file
+
+
+# The responses can be streamed as one JSON document per line
+STREAM_CONTENT_TYPE = 'application/x-json-stream'
+
+# The requests are only sent again with the body to the new location on
+# the temporary and the permanent redirects.
+REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
 
 class Settings:
     base_url = os.environ.get(
@@ -28,8 +67,125 @@ class Settings:
     )
     timeout = 60
     tries = 3
+    # The retries are spread over exponentially growing intervals starting
+    # with this one until the maximum
     sleep_interval = 5
+    max_sleep_interval = 60
+    max_redirects = 10
     auth_token = None
+    # Number of the idle connections to keep open to every host
+    idle_connections = 4
+    # Number of the responses to keep in the memory for the requests with
+    # a cache TTL
+    response_cache_size = 32
+    # Maximum number of characters of a response to keep in the memory
+    max_cached_response_size = 1024 * 1024
+    # Directory to share the cached responses of the queries with
+    # the other processes
+    cache_dir = os.environ.get('SERVERADMIN_CACHE_DIR')
+    # Number of seconds to use the schema of the attributes before
+    # revalidating it
+    schema_ttl = 300
+
+
+# The entity tags, the lines and the times of the responses by the URL and
+# the request body
+_response_cache = OrderedDict()
+_response_cache_lock = Lock()
+
+
+class ConnectionPool(object):
+    """Keep the connections open to reuse them for the next requests
+
+    The connections are only reused after their responses are read
+    completely.  The idle connections may be closed by the server anytime,
+    so the requests are sent again on a new connection, if the idle one
+    turns out to be closed before anything is received.  They are not
+    sent again after the other errors including the timeouts, because
+    the server may have already executed them.
+    """
+    def __init__(self):
+        self._idle = defaultdict(list)
+        self._lock = Lock()
+
+    def urlopen(self, request):
+        """Send the request and return the connection with the response"""
+        key = request.type, request.host
+        with self._lock:
+            connection = self._idle[key].pop() if self._idle[key] else None
+        if connection is not None:
+            try:
+                return connection, self._send(connection, request)
+            except (HTTPException, SocketError) as error:
+                connection.close()
+                if not is_stale_connection_error(error):
+                    raise
+
+        connection = self._connect(*key)
+        try:
+            return connection, self._send(connection, request)
+        except (HTTPException, SocketError):
+            connection.close()
+            raise
+
+    def release(self, connection, response):
+        """Keep the connection, if the response is completely read"""
+        key = connection.scheme, connection.netloc
+        with self._lock:
+            idle = self._idle[key]
+            if (
+                response.isclosed() and
+                not response.will_close and
+                len(idle) < Settings.idle_connections
+            ):
+                idle.append(connection)
+                return
+        connection.close()
+
+    def _connect(self, scheme, netloc):
+        connection_class = HTTPSConnection if scheme == 'https' else (
+            HTTPConnection
+        )
+        proxy = getproxies().get(scheme)
+        if proxy and not proxy_bypass(netloc):
+            connection = connection_class(
+                urlparse(proxy).netloc, timeout=Settings.timeout
+            )
+            connection.set_tunnel(netloc)
+        else:
+            connection = connection_class(netloc, timeout=Settings.timeout)
+        connection.scheme = scheme
+        connection.netloc = netloc
+        return connection
+
+    def _send(self, connection, request):
+        # The errors before the request is sent are safe to try again like
+        # the ones of urlopen().
+        try:
+            connection.request(
+                request.get_method(),
+                request.selector,
+                request.data,
+                dict(request.header_items()),
+            )
+        except SocketError as error:
+            raise URLError(error)
+        return connection.getresponse()
+
+
+_connection_pool = ConnectionPool()
+
+
+def is_stale_connection_error(error):
+    """Check whether the connection was closed before receiving anything"""
+    if isinstance(error, URLError):
+        error = error.reason
+    # The RemoteDisconnected of Python 3.5 is a BadStatusLine.
+    if isinstance(error, BadStatusLine):
+        return True
+    return isinstance(error, SocketError) and error.errno in (
+        EPIPE, ECONNRESET
+    )
 
 
 class APIError(Exception):
@@ -55,26 +211,258 @@ def calc_app_id(auth_token):
 
 
 def send_request(endpoint, get_params=None, post_params=None):
+    return next(stream_request(endpoint, get_params, post_params))
+
+
+def stream_request(
+    endpoint, get_params=None, post_params=None, cache_ttl=None
+):
+    """Send the request and iterate the JSON documents on the response
+
+    The response is parsed while it is being read.  The responses that
+    are not streamed are returned as a single document.
+
+    The responses are only kept, if the cache TTL is given.  They are used
+    without asking the server until they are older than the TTL.  After
+    that, the request is made conditional with the entity tag of the kept
+    response, and if the server tells that nothing has changed, the kept
+    documents are returned again.  The responses are kept on the disk to
+    be shared with the other processes, if Settings.cache_dir is set,
+    otherwise in the memory up to a size.
+    """
     if not Settings.auth_token:
         Settings.auth_token = get_auth_token()
 
-    request = _build_request(
+    if cache_ttl is None:
+        lines = _request_lines(build_request(
+            endpoint, Settings.auth_token, get_params, post_params
+        ))
+    elif Settings.cache_dir:
+        lines = _request_cached_lines(
+            endpoint, get_params, post_params, cache_ttl
+        )
+    else:
+        lines = _request_kept_lines(
+            endpoint, get_params, post_params, cache_ttl
+        )
+    for line in lines:
+        yield json.loads(line)
+
+
+def _request_kept_lines(endpoint, get_params, post_params, cache_ttl):
+    """Return the lines of the response from the memory of the process"""
+    request = build_request(
         endpoint, Settings.auth_token, get_params, post_params
     )
-    for retry in reversed(range(Settings.tries)):
-        response = _try_request(request, retry)
-        if response:
-            break
+    cache_key = request.get_full_url(), request.data
+    with _response_cache_lock:
+        entry = _response_cache.get(cache_key)
+    if entry is None:
+        cached_response = None
+    else:
+        etag, lines, stored_on = entry
+        if time.time() - stored_on < cache_ttl:
+            return lines
+        cached_response = etag, lines
+    return _request_lines(
+        request,
+        cached_response,
+        partial(_cache_response, cache_key),
+        Settings.max_cached_response_size,
+    )
 
-        # In case of an error, sleep before trying again
-        time.sleep(Settings.sleep_interval)
+
+def _request_cached_lines(endpoint, get_params, post_params, cache_ttl):
+    """Return the lines of the response from the cache on the disk
+
+    The cache entry is locked until it is refreshed, so that the other
+    processes don't send the same request at the same time.
+    """
+    key_json = json.dumps(
+        [
+            Settings.base_url,
+            calc_app_id(Settings.auth_token),
+            endpoint,
+            get_params,
+            post_params,
+        ],
+        default=_json_encode_canonical,
+        sort_keys=True,
+    )
+    path = os.path.join(
+        Settings.cache_dir, sha1(key_json.encode('utf8')).hexdigest()
+    )
+    _make_cache_dir()
+    with open(path + '.lock', 'a') as lock_file:
+        if flock is not None:
+            flock(lock_file, LOCK_EX)
+        entry = _read_cache_entry(path)
+        if entry is not None and time.time() - entry['stored_on'] < cache_ttl:
+            return entry['lines']
+
+        # The request must be signed after waiting for the lock.
+        request = build_request(
+            endpoint, Settings.auth_token, get_params, post_params
+        )
+        cached_response = None
+        if entry is not None:
+            cached_response = entry['etag'], entry['lines']
+        return list(_request_lines(
+            request, cached_response, partial(_write_cache_entry, path)
+        ))
+
+
+def _request_lines(request, cached_response=None, store=None, max_size=None):
+    """Send the request and iterate the lines of the response
+
+    The request is conditional, if a response is given.  The responses with
+    an entity tag up to the maximum size are passed to the store function,
+    if it is given.
+    """
+    if cached_response is not None:
+        request.add_header('If-None-Match', cached_response[0])
+
+    connection, response = _send_request(request)
+    if store is None or not response.getheader('ETag'):
+        store = None
+    if response.getheader('Content-Type') == STREAM_CONTENT_TYPE:
+        return _stream_lines(connection, response, store, max_size)
+    return _read_lines(connection, response, cached_response, store, max_size)
+
+
+def _read_lines(connection, response, cached_response, store, max_size):
+    try:
+        body = response.read().decode()
+    finally:
+        _connection_pool.release(connection, response)
+
+    if response.status == 304 and cached_response is not None:
+        if store is not None:
+            store(*cached_response)
+        return cached_response[1]
+    if store is not None and (max_size is None or len(body) <= max_size):
+        store(response.getheader('ETag'), [body])
+    return [body]
+
+
+def _stream_lines(connection, response, store, max_size):
+    """Iterate the lines of the streamed response
+
+    The response can only be kept after it is completely read.
+    The connection is closed, if the iteration is stopped before.
+    """
+    lines = None if store is None else []
+    size = 0
+    try:
+        for line in response:
+            line = line.decode()
+            if lines is not None:
+                size += len(line)
+                if max_size is not None and size > max_size:
+                    lines = None
+                else:
+                    lines.append(line)
+            yield line
+    finally:
+        _connection_pool.release(connection, response)
+    if lines is not None:
+        store(response.getheader('ETag'), lines)
+
+
+def _send_request(request):
+    """Send the request following the redirects"""
+    for redirect in range(Settings.max_redirects + 1):
+        connection, response = _retry_request(request)
+        if response.status not in REDIRECT_STATUSES:
+            return connection, response
+
+        body = response.read()
+        _connection_pool.release(connection, response)
+        if redirect == Settings.max_redirects:
+            raise HTTPError(
+                request.get_full_url(),
+                response.status,
+                'Too many redirects',
+                response.msg,
+                BytesIO(body),
+            )
+        request = redirect_request(
+            request, response.status, response.getheader('Location')
+        )
+
+
+def redirect_request(request, status, location):
+    """Build the request to the new location like the browsers do"""
+    if status in (307, 308):
+        data = request.data
     else:
-        assert False    # Cannot happen
+        data = None
+    return Request(
+        urljoin(request.get_full_url(), location),
+        data,
+        dict(request.header_items()),
+    )
+
+
+def _retry_request(request):
+    for attempt in range(Settings.tries):
+        result = _try_request(request, attempt + 1 < Settings.tries)
+        if result is not None:
+            return result
+
+        # In case of an error, sleep before trying again
+        time.sleep(get_retry_interval(attempt))
 
-    return json.loads(response.read().decode())
+    assert False    # Cannot happen
 
 
-def _build_request(endpoint, auth_token, get_params, post_params):
+def get_retry_interval(attempt):
+    """Randomize the intervals not to retry together with the other clients"""
+    return uniform(0, min(
+        Settings.sleep_interval * 2 ** attempt,
+        Settings.max_sleep_interval,
+    ))
+
+
+def _cache_response(cache_key, etag, lines):
+    with _response_cache_lock:
+        _response_cache.pop(cache_key, None)
+        _response_cache[cache_key] = etag, lines, time.time()
+        while len(_response_cache) > Settings.response_cache_size:
+            _response_cache.popitem(last=False)
+
+
+def _make_cache_dir():
+    # The cache directory is only readable by the user, because the API
+    # may not be accessible by the others.
+    try:
+        os.makedirs(Settings.cache_dir, 0o700)
+    except OSError:
+        if not os.path.isdir(Settings.cache_dir):
+            raise
+
+
+def _read_cache_entry(path):
+    try:
+        with open(path) as cache_file:
+            return json.load(cache_file)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_cache_entry(path, etag, lines):
+    """Replace the entry atomically for the processes reading without lock"""
+    with NamedTemporaryFile(
+        'w', dir=os.path.dirname(path), delete=False
+    ) as cache_file:
+        json.dump(
+            {'etag': etag, 'lines': lines, 'stored_on': time.time()},
+            cache_file,
+        )
+    replace_file(cache_file.name, path)
+
+
+def build_request(endpoint, auth_token, get_params, post_params):
     if post_params:
         post_data = json.dumps(post_params, default=json_encode_extra)
     else:
@@ -100,23 +488,43 @@ def _build_request(endpoint, auth_token, get_params, post_params):
 
 def _try_request(request, retry=False):
     try:
-        return urlopen(request, timeout=Settings.timeout)
-    except HTTPError as error:
-        if error.code >= 500:
-            if retry:
-                return None
-        elif error.code >= 400:
-            content_type = error.info()['Content-Type']
-            if content_type == 'application/x-json':
-                payload = json.loads(error.read().decode())
-                message = payload['error']['message']
-                raise APIError(message, status_code=error.code)
-        raise
+        connection, response = _connection_pool.urlopen(request)
     except (SSLError, URLError):
         if retry:
             return None
         raise
 
+    if response.status < 300 or response.status == 304:
+        return connection, response
+    if (
+        response.status in REDIRECT_STATUSES and
+        response.getheader('Location')
+    ):
+        return connection, response
+
+    body = response.read()
+    _connection_pool.release(connection, response)
+    if response.status >= 500:
+        if retry:
+            return None
+    elif response.getheader('Content-Type') == 'application/x-json':
+        payload = json.loads(body.decode())
+        message = payload['error']['message']
+        raise APIError(message, status_code=response.status)
+    raise HTTPError(
+        request.get_full_url(),
+        response.status,
+        response.reason,
+        response.msg,
+        BytesIO(body),
+    )
+
+
+def _json_encode_canonical(obj):
+    if isinstance(obj, set):
+        return sorted(obj)
+    return json_encode_extra(obj)
+
 
 def json_encode_extra(obj):
     if isinstance(obj, BaseFilter):
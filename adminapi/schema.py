@@ -0,0 +1,92 @@
+"""adminapi - The schema of the attributes
+
+Copyright (c) 2017, InnoGames GmbH
+"""
+
+from threading import Lock
+import time
+
+from adminapi.datatype import TYPE_DECODERS, json_to_datatype
+from adminapi.request import HTTPError, Settings, send_request
+
+SCHEMA_ENDPOINT = '/dataset/schema'
+
+# The schemas by the base URL of the server
+_schemas = {}
+_schemas_lock = Lock()
+
+
+class Schema(object):
+    """Convert the values by the types of the attributes on the server
+
+    The converters are looked up by the attribute ids.  The values of
+    the attributes which are not in the schema are still guessed from their
+    formats.
+    """
+    def __init__(self, version=None, attributes={}):
+        self.version = version
+        self.fetched_on = time.time()
+        self._converters = {
+            attribute_id: get_type_converter(spec['type'])
+            for attribute_id, spec in attributes.items()
+        }
+
+    def is_expired(self):
+        return time.time() - self.fetched_on > Settings.schema_ttl
+
+    def get_converter(self, attribute_id):
+        return self._converters.get(attribute_id, json_to_datatype)
+
+
+def get_schema():
+    """Return the schema of the server fetching it, if necessary
+
+    The schema is kept by the process, and revalidated after it expires.
+    The older servers without the schema are also remembered.
+    """
+    schema = get_cached_schema()
+    if schema is None:
+        try:
+            response = send_request(SCHEMA_ENDPOINT)
+        except HTTPError as error:
+            if error.code != 404:
+                raise
+            response = None
+        schema = cache_schema(response)
+    return schema
+
+
+def get_cached_schema():
+    with _schemas_lock:
+        schema = _schemas.get(Settings.base_url)
+    if schema is None or schema.is_expired():
+        return None
+    return schema
+
+
+def cache_schema(response):
+    if response is None:
+        schema = Schema()
+    else:
+        schema = Schema(response['version'], response['attributes'])
+    with _schemas_lock:
+        _schemas[Settings.base_url] = schema
+    return schema
+
+
+def get_type_converter(attribute_type):
+    """Return the function to convert the values of the attribute type"""
+    if attribute_type not in TYPE_DECODERS:
+        return _identity
+    decoder = TYPE_DECODERS[attribute_type]
+
+    def convert(value):
+        if value is None:
+            return None
+        return decoder(value)
+
+    return convert
+
+
+def _identity(value):
+    return value
@@ -1,6 +1,7 @@
 from time import time
 from functools import update_wrapper
 from logging import getLogger
+from types import GeneratorType
 try:
     import simplejson as json
 except ImportError:
@@ -12,11 +13,19 @@ from django.core.exceptions import (
     PermissionDenied,
     ValidationError,
 )
-from django.http import HttpResponse
+from django.http import (
+    HttpResponse,
+    HttpResponseBase,
+    StreamingHttpResponse,
+)
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.crypto import constant_time_compare
 
-from adminapi.request import calc_security_token, json_encode_extra
+from adminapi.request import (
+    STREAM_CONTENT_TYPE,
+    calc_security_token,
+    json_encode_extra,
+)
 from adminapi.filters import FilterValueError
 from serveradmin.apps.models import Application
 from serveradmin.api import AVAILABLE_API_FUNCTIONS
@@ -24,6 +33,11 @@ from serveradmin.api import AVAILABLE_API_FUNCTIONS
 logger = getLogger('serveradmin')
 
 
+class JSONText(str):
+    """Already serialized JSON document to be streamed as it is"""
+    pass
+
+
 def api_view(view):
     @csrf_exempt
     def _wrapper(request):
@@ -68,13 +82,38 @@ def api_view(view):
             'Application: {}'.format(app),
             'Time elapsed: {:.3f}s'.format(time() - now),
         ])))
-        return HttpResponse(
-            json.dumps(return_value, default=json_encode_extra),
-            content_type='application/x-json',
+
+        if isinstance(return_value, HttpResponseBase):
+            return return_value
+        return build_response(return_value, status_code)
+
+    return update_wrapper(_wrapper, view)
+
+
+def build_response(return_value, status_code=200):
+    """Serialize the return value of a view to the response"""
+    # The views can return generators to stream the documents one
+    # per line.
+    if isinstance(return_value, GeneratorType):
+        return StreamingHttpResponse(
+            (
+                (
+                    d if isinstance(d, JSONText)
+                    else json.dumps(d, default=json_encode_extra)
+                ) + '\n'
+                for d in return_value
+            ),
+            content_type=STREAM_CONTENT_TYPE,
             status=status_code,
         )
 
-    return update_wrapper(_wrapper, view)
+    if not isinstance(return_value, JSONText):
+        return_value = json.dumps(return_value, default=json_encode_extra)
+    return HttpResponse(
+        return_value,
+        content_type='application/x-json',
+        status=status_code,
+    )
 
 
 def authenticate_app(app, token, timestamp, now, body):
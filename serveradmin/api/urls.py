@@ -3,6 +3,11 @@ from django.conf.urls import url
 from serveradmin.api.views import (
     doc_functions,
     dataset_query,
+    dataset_multi_query,
+    dataset_explain,
+    dataset_schema,
+    dataset_changes,
+    dataset_watch,
     dataset_commit,
     dataset_new_object,
     dataset_create,
@@ -12,6 +17,11 @@ from serveradmin.api.views import (
 urlpatterns = [
     url('^functions$', doc_functions),
     url('^dataset/query$', dataset_query),
+    url('^dataset/multi_query$', dataset_multi_query),
+    url('^dataset/explain$', dataset_explain),
+    url('^dataset/schema$', dataset_schema),
+    url('^dataset/changes$', dataset_changes),
+    url('^dataset/watch$', dataset_watch),
     url('^dataset/commit$', dataset_commit),
     url('^dataset/new_object$', dataset_new_object),
     url('^dataset/create$', dataset_create),
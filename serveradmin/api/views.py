@@ -1,24 +1,63 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import timedelta
+from itertools import chain
 from operator import itemgetter
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 from django.core.exceptions import (
+    ObjectDoesNotExist,
     SuspiciousOperation,
     PermissionDenied,
     ValidationError,
 )
 from django.contrib.auth.decorators import login_required
 from django.contrib.admindocs.utils import trim_docstring, parse_docstring
+from django.db import DatabaseError
+from django.db.models import Max, Min
+from django.http import HttpResponseNotModified
 from django.template.response import TemplateResponse
+from django.utils.timezone import now
 
 from adminapi.filters import FilterValueError, filter_from_obj
 from serveradmin.api import ApiError, AVAILABLE_API_FUNCTIONS
-from serveradmin.api.decorators import api_view
+from serveradmin.api.decorators import JSONText, api_view, build_response
 from serveradmin.api.utils import build_function_description
+from adminapi.request import json_encode_extra
+from serveradmin.dataset import Query
+from serveradmin.serverdb.models import (
+    Attribute,
+    ChangeAdd,
+    ChangeCommit,
+    ChangeDelete,
+    ChangeUpdate,
+    lookup_version,
+)
+from serveradmin.serverdb.query_cache import MAX_CACHED_SERVERS, CachedQuery
 from serveradmin.serverdb.query_committer import QueryCommitter
 from serveradmin.serverdb.query_filterer import QueryFilterer
+from serveradmin.serverdb.query_json_materializer import (
+    QueryJSONMaterializer,
+    can_materialize_json,
+)
 from serveradmin.serverdb.query_materializer import (
     QueryMaterializer,
     get_default_attribute_values,
 )
+from serveradmin.serverdb.query_watcher import QueryWatcher
+
+# Number of servers to materialize at once for the streamed responses
+STREAM_CHUNK_SIZE = 1000
+
+# The commits are not necessarily visible in the order of their ids.  The ones
+# created in this interval may still be in progress, so they are returned
+# again on the next request of the change feed.
+CHANGES_COMMIT_LAG = timedelta(minutes=1)
+
+# Maximum number of seconds to wait for the commits affecting a query
+WATCH_TIMEOUT = 30
 
 
 class StringEncoder(object):
@@ -65,28 +104,180 @@ def doc_functions(request):
 @api_view
 def dataset_query(request, app, data):
     try:
-        if 'filters' not in data or not isinstance(data['filters'], dict):
-            raise SuspiciousOperation('Filters must be a dictionary')
-        filters = {}
-        for attr, filter_obj in data['filters'].items():
-            filters[attr] = filter_from_obj(filter_obj)
-
-        # Empty list means query all attributes to the older versions of
-        # the adminapi.
-        if not data.get('restrict'):
-            restrict = None
+        filters, restrict, order_by = _parse_query(data)
+
+        if 'page_size' in data:
+            return _dataset_query_page(
+                filters, restrict, order_by, data['page_size'],
+                data.get('cursor'),
+            )
+
+        # The cache has to be checked before the query is executed.
+        cached_query = CachedQuery(filters, restrict, order_by)
+        stream = bool(data.get('stream'))
+        # The columns are only supported on the streamed responses
+        # without joins.
+        columns = stream and data.get('format') == 'columns' and (
+            restrict is None or all(isinstance(r, str) for r in restrict)
+        )
+        if columns:
+            representation = 'columns'
         else:
-            restrict = data['restrict']
+            representation = 'stream' if stream else 'json'
+        etag = cached_query.get_etag(representation)
+        if etag in _parse_etags(request.META.get('HTTP_IF_NONE_MATCH')):
+            response = HttpResponseNotModified()
+        else:
+            response = build_response(_dataset_query_results(
+                filters, restrict, order_by, stream, cached_query, columns
+            ))
+        response['ETag'] = etag
+
+        return response
+    except (FilterValueError, ValidationError) as error:
+        return {
+            'status': 'error',
+            'type': 'ValueError',
+            'message': str(error),
+        }
+
+
+@api_view
+def dataset_multi_query(request, app, data):
+    """Execute the queries and return their results in one response
+
+    The results are in the order of the queries, each with its own status,
+    so the errors of a query don't affect the others.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('queries'), list):
+        raise SuspiciousOperation('Queries must be a list')
+
+    results = []
+    for query_data in data['queries']:
+        if not isinstance(query_data, dict):
+            raise SuspiciousOperation('Query must be a dictionary')
+        try:
+            filters, restrict, order_by = _parse_query(query_data)
+            results.append(_dataset_query_results(
+                filters, restrict, order_by, False,
+                CachedQuery(filters, restrict, order_by),
+            ))
+        except (FilterValueError, ValidationError) as error:
+            results.append(_serialize({
+                'status': 'error',
+                'type': 'ValueError',
+                'message': str(error),
+            }))
+        except ObjectDoesNotExist as error:
+            results.append(_serialize({
+                'status': 'error',
+                'type': error.__class__.__name__,
+                'message': str(error),
+            }))
+
+    return JSONText(
+        '{"status": "success", "results": [' + ', '.join(results) + ']}'
+    )
+
 
-        order_by = data.get('order_by')
+@api_view
+def dataset_schema(request, app, data):
+    """Return the types of the attributes with the version of the schema
+
+    The version changes together with the attributes, so the clients can
+    keep the schema and revalidate it with a conditional request.
+    """
+    version = lookup_version.get()
+    etag = '"{}"'.format(version)
+    if etag in _parse_etags(request.META.get('HTTP_IF_NONE_MATCH')):
+        response = HttpResponseNotModified()
+    else:
+        response = build_response({
+            'status': 'success',
+            'version': version,
+            'attributes': {
+                a.pk: {'type': a.type, 'multi': a.multi}
+                for a in Attribute.objects.all()
+            },
+        })
+    response['ETag'] = etag
 
-        filterer = QueryFilterer(filters)
-        materializer = QueryMaterializer(filterer, restrict, order_by)
+    return response
+
+
+@api_view
+def dataset_explain(request, app, data):
+    """Execute the query and return its SQL, plan and timings"""
+    try:
+        filters, restrict, order_by = _parse_query(data)
 
         return {
             'status': 'success',
-            'result': list(materializer),
+            'result': Query(filters, restrict, order_by).explain(),
+        }
+    except (FilterValueError, ValidationError) as error:
+        return {
+            'status': 'error',
+            'type': 'ValueError',
+            'message': str(error),
+        }
+
+
+@api_view
+def dataset_changes(request, app, data):
+    """Stream the servers changed by the commits after the given one
+
+    The servers are followed by a status document with the ids of the changed
+    servers which don't match the filters anymore, and the commit id to
+    request the next changes with.  All of the servers are returned, if
+    the commit id is not given.
+    """
+    try:
+        filters, restrict, order_by = _parse_query(data)
+        if order_by:
+            raise FilterValueError('Changes cannot be ordered')
+        since = _parse_commit_id(request.GET.get('since'))
+
+        return _stream_changes(filters, restrict, since)
+    except (FilterValueError, ValidationError) as error:
+        return {
+            'status': 'error',
+            'type': 'ValueError',
+            'message': str(error),
         }
+
+
+@api_view
+def dataset_watch(request, app, data):
+    """Wait for the commits affecting the query and return the changes
+
+    The response is the same as of the change feed.  It is returned
+    immediately, if there are newer commits than the last one
+    the client has seen, otherwise after a commit changing any of
+    the attributes the query depends on, or after the timeout.  The clients
+    are expected to repeat the request with the returned commit ids.
+    """
+    try:
+        filters, restrict, order_by = _parse_query(data)
+        if order_by:
+            raise FilterValueError('Changes cannot be ordered')
+        if 'since' not in request.GET:
+            raise SuspiciousOperation('Commit id is required')
+        since = _parse_commit_id(request.GET['since'])
+        seen = _parse_commit_id(request.GET.get('seen'))
+        try:
+            timeout = min(
+                float(request.GET.get('timeout', WATCH_TIMEOUT)),
+                WATCH_TIMEOUT,
+            )
+        except ValueError as error:
+            raise SuspiciousOperation(error)
+
+        with QueryWatcher(filters, restrict) as watcher:
+            if seen is None or _get_last_commit_id() > seen:
+                return _stream_changes(filters, restrict, since)
+            watcher.wait(timeout)
+        return _stream_changes(filters, restrict, since)
     except (FilterValueError, ValidationError) as error:
         return {
             'status': 'error',
@@ -95,6 +286,271 @@ def dataset_query(request, app, data):
         }
 
 
+def _parse_commit_id(commit_id):
+    if commit_id is None:
+        return None
+    try:
+        return int(commit_id)
+    except ValueError as error:
+        raise SuspiciousOperation(error)
+
+
+def _stream_changes(filters, restrict, since):
+    # The commit ids have to be selected before the servers, so that
+    # the commits in between are returned again next time.
+    last_commit_id = _get_last_commit_id()
+    commit_id = _get_visible_commit_id(since, last_commit_id)
+    if since is None:
+        servers = list(QueryFilterer(filters))
+        deleted = []
+    else:
+        server_ids = _get_changed_server_ids(since)
+        if server_ids:
+            servers = list(QueryFilterer(filters, server_ids=server_ids))
+        else:
+            servers = []
+        deleted = sorted(server_ids - {s.server_id for s in servers})
+
+    return _stream_chunks(
+        (
+            _materialize_chunk(servers[i:(i + STREAM_CHUNK_SIZE)], restrict)
+            for i in range(0, len(servers), STREAM_CHUNK_SIZE)
+        ),
+        status={
+            'commit_id': commit_id,
+            'last_commit_id': last_commit_id,
+            'deleted': deleted,
+        },
+    )
+
+
+def _get_last_commit_id():
+    return ChangeCommit.objects.aggregate(Max('id'))['id__max'] or 0
+
+
+def _get_visible_commit_id(since, last_commit_id):
+    """Get the last commit id until which all commits are visible"""
+    recent = ChangeCommit.objects.filter(
+        change_on__gte=now() - CHANGES_COMMIT_LAG
+    ).aggregate(Min('id'))['id__min']
+    commit_id = last_commit_id if recent is None else recent - 1
+
+    # The commit id is never moved backwards.
+    if since is not None and since > commit_id:
+        return since
+    return commit_id
+
+
+def _get_changed_server_ids(since):
+    server_ids = set()
+    for model in (ChangeAdd, ChangeUpdate, ChangeDelete):
+        server_ids.update(model.objects.filter(
+            commit_id__gt=since
+        ).values_list('server_id', flat=True))
+    return server_ids
+
+
+def _parse_query(data):
+    if 'filters' not in data or not isinstance(data['filters'], dict):
+        raise SuspiciousOperation('Filters must be a dictionary')
+    filters = {}
+    for attr, filter_obj in data['filters'].items():
+        filters[attr] = filter_from_obj(filter_obj)
+
+    # Empty list means query all attributes to the older versions of
+    # the adminapi.
+    if not data.get('restrict'):
+        restrict = None
+    else:
+        restrict = data['restrict']
+
+    return filters, restrict, data.get('order_by')
+
+
+def _dataset_query_results(
+    filters, restrict, order_by, stream, cached_query, columns=False
+):
+    # The cache only keeps the servers as objects.
+    if columns:
+        chunks = _encode_columns(_materialize_chunks(
+            filters, restrict, order_by, materialize_json=False
+        ))
+        return _stream_chunks(chain([next(chunks)], chunks))
+
+    documents = cached_query.get()
+
+    if stream:
+        if documents is not None:
+            return _stream_chunks([documents])
+
+        chunks = _materialize_chunks(filters, restrict, order_by)
+        # Materialize the first chunk before the response is started
+        # to be able to return the errors with it.
+        first_chunk = next(chunks)
+        return _stream_chunks(chain([first_chunk], chunks), cached_query)
+
+    if documents is None:
+        documents = [
+            _serialize(s) for s in Query(filters, restrict, order_by)
+        ]
+        cached_query.set(documents)
+
+    return JSONText(
+        '{"status": "success", "result": [' + ', '.join(documents) + ']}'
+    )
+
+
+def _parse_etags(header):
+    if not header:
+        return []
+    return [e.strip() for e in header.split(',')]
+
+
+def _dataset_query_page(filters, restrict, order_by, page_size, cursor):
+    """Return a page of the results with the cursor to the next one
+
+    The pages are selected by the hostname of the last server of
+    the previous page, so they are consistent with the concurrent commits,
+    and each of them is equally cheap to query.
+    """
+    if not isinstance(page_size, int) or page_size <= 0:
+        raise SuspiciousOperation('Page size must be a positive integer')
+    if order_by:
+        raise FilterValueError('Pages cannot be ordered')
+
+    after_hostname = None if cursor is None else _decode_cursor(cursor)
+    servers = list(QueryFilterer(
+        filters, limit=page_size + 1, after_hostname=after_hostname
+    ))
+    if len(servers) > page_size:
+        servers = servers[:page_size]
+        next_cursor = _encode_cursor(servers[-1].hostname)
+    else:
+        next_cursor = None
+
+    return {
+        'status': 'success',
+        'result': list(QueryMaterializer(servers, restrict)),
+        'cursor': next_cursor,
+    }
+
+
+def _materialize_chunks(filters, restrict, order_by, materialize_json=True):
+    """Materialize the servers in chunks of bounded size
+
+    The chunks are selected the same way as the pages, unless they have
+    to be ordered.
+    """
+    if order_by:
+        yield list(Query(filters, restrict, order_by))
+        return
+
+    after_hostname = None
+    while True:
+        servers = list(QueryFilterer(
+            filters, limit=STREAM_CHUNK_SIZE, after_hostname=after_hostname
+        ))
+        if materialize_json:
+            yield _materialize_chunk(servers, restrict)
+        else:
+            yield QueryMaterializer(servers, restrict)
+        if len(servers) < STREAM_CHUNK_SIZE:
+            break
+        after_hostname = servers[-1].hostname
+
+
+def _materialize_chunk(servers, restrict):
+    """Let the database build the JSON documents when possible"""
+    if can_materialize_json({s.servertype for s in servers}, restrict):
+        return (
+            JSONText(d) for d in QueryJSONMaterializer(servers, restrict)
+        )
+    return QueryMaterializer(servers, restrict)
+
+
+def _encode_columns(chunks):
+    """Encode the servers as the rows of the column sets
+
+    The column sets are the lists of the attribute ids with their types.
+    They are sent before the first row using them.  The rows are arrays of
+    the index of their column set followed by the values.  The servers of
+    the same servertype share the same column set.
+    """
+    column_sets = {}
+    for chunk in chunks:
+        documents = []
+        for server in chunk:
+            attribute_ids = tuple(server.keys())
+            index = column_sets.get(attribute_ids)
+            if index is None:
+                index = column_sets[attribute_ids] = len(column_sets)
+                documents.append({
+                    'columns': attribute_ids,
+                    'types': [
+                        Attribute.objects.get(pk=a).type
+                        for a in attribute_ids
+                    ],
+                })
+            documents.append([index] + [server[a] for a in attribute_ids])
+        yield documents
+
+
+def _stream_chunks(chunks, cached_query=None, status=None):
+    """Yield the servers followed by a status document
+
+    The serialized servers are added to the cache, if the query is given,
+    and the response is completed.  The given status is added to
+    the status document.
+    """
+    documents = []
+    try:
+        for chunk in chunks:
+            for server in chunk:
+                document = _serialize(server)
+                if documents is not None:
+                    documents.append(document)
+                    if len(documents) > MAX_CACHED_SERVERS:
+                        documents = None
+                yield document
+    except (FilterValueError, ValidationError) as error:
+        yield {
+            'status': 'error',
+            'type': 'ValueError',
+            'message': str(error),
+        }
+    except (ObjectDoesNotExist, DatabaseError) as error:
+        # The response is already started, so the error can only be
+        # reported by the status document.
+        yield {
+            'status': 'error',
+            'type': error.__class__.__name__,
+            'message': str(error),
+        }
+    else:
+        if cached_query is not None and documents is not None:
+            cached_query.set(documents)
+        yield dict(status or {}, status='success')
+
+
+def _serialize(server):
+    if isinstance(server, JSONText):
+        return server
+    return JSONText(json.dumps(server, default=json_encode_extra))
+
+
+def _encode_cursor(hostname):
+    cursor_json = json.dumps({'hostname': hostname})
+    return urlsafe_b64encode(cursor_json.encode('utf8')).decode('ascii')
+
+
+def _decode_cursor(cursor):
+    try:
+        cursor_json = urlsafe_b64decode(cursor.encode('ascii')).decode('utf8')
+        return json.loads(cursor_json)['hostname']
+    except (AttributeError, TypeError, ValueError, KeyError) as error:
+        raise SuspiciousOperation('Invalid cursor: {}'.format(error))
+
+
 @api_view
 def dataset_new_object(request, app, data):
     try:
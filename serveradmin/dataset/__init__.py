@@ -1,6 +1,15 @@
-from adminapi.dataset import BaseQuery, DatasetObject
+from collections import OrderedDict
+from itertools import islice
+from time import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from adminapi.dataset import BaseQuery, DatasetError, DatasetObject
+from adminapi.request import json_encode_extra
 from serveradmin.serverdb.query_committer import QueryCommitter
-from serveradmin.serverdb.query_filterer import QueryFilterer
+from serveradmin.serverdb.query_filterer import QueryFilterer, can_order_by
 from serveradmin.serverdb.query_materializer import (
     QueryMaterializer,
     get_default_attribute_values,
@@ -8,6 +17,17 @@ from serveradmin.serverdb.query_materializer import (
 
 
 class Query(BaseQuery):
+    def __init__(
+        self,
+        filters=None,
+        restrict=None,
+        order_by=None,
+        limit=None,
+        offset=None,
+    ):
+        super(Query, self).__init__(filters, restrict, order_by)
+        self._limit = limit
+        self._offset = offset
 
     def _fetch_new_object(self, servertype):
         return DatasetObject(get_default_attribute_values(servertype))
@@ -17,9 +37,93 @@ class Query(BaseQuery):
         QueryCommitter(app=app, user=user, **commit)()
         self._confirm_changes()
 
+    def count(self):
+        """Return the number of the matching servers ignoring the limit
+
+        The servers are counted on the database without materializing
+        them.
+        """
+        # The query without filters only has the new objects which are not
+        # limited.
+        if self._filters is None:
+            return len(self._results)
+        return QueryFilterer(self._filters).count()
+
+    def explain(self):
+        """Return the SQL, the plan and the timings of the query
+
+        The query is executed to measure the timings of the phases.
+        The plan is collected by the database executing it once more.
+        """
+        if self._filters is None:
+            raise DatasetError('Query without filters cannot be explained')
+
+        timings = OrderedDict()
+        start = time()
+        filterer, materializer_order_by = self._get_filterer()
+        servers = list(filterer)
+        timings['filtering'] = time() - start
+
+        start = time()
+        materializer = QueryMaterializer(
+            servers, self._restrict, materializer_order_by
+        )
+        results = list(self._limit_results(
+            materializer, materializer_order_by
+        ))
+        timings['materialization'] = time() - start
+        timings['materialization_phases'] = materializer.timings
+
+        start = time()
+        json.dumps(results, default=json_encode_extra)
+        timings['serialization'] = time() - start
+
+        if filterer.get_possible_servertypes():
+            sql, params = filterer.get_sql()
+        else:
+            sql, params = None, []
+
+        return {
+            'sql': sql,
+            'params': params,
+            'possible_servertypes': sorted(
+                s.pk for s in filterer.get_possible_servertypes()
+            ),
+            'plan': filterer.explain(),
+            'num_servers': len(results),
+            'timings': timings,
+        }
+
     def _fetch_results(self):
-        filterer = QueryFilterer(self._filters)
-        return QueryMaterializer(filterer, self._restrict, self._order_by)
+        filterer, materializer_order_by = self._get_filterer()
+        materializer = QueryMaterializer(
+            filterer, self._restrict, materializer_order_by
+        )
+        return self._limit_results(materializer, materializer_order_by)
+
+    def _get_filterer(self):
+        """Return the filterer, and the order the materializer should sort
+
+        The results are ordered and limited by the database, when possible.
+        """
+        if not self._order_by or can_order_by(self._order_by):
+            filterer = QueryFilterer(
+                self._filters, self._order_by, self._limit, self._offset
+            )
+            return filterer, None
+
+        # Otherwise the results have to be sorted by the materializer,
+        # so we cannot let the database limit them.
+        return QueryFilterer(self._filters), self._order_by
+
+    def _limit_results(self, materializer, materializer_order_by):
+        if not materializer_order_by:
+            return materializer
+
+        offset = self._offset or 0
+        if self._limit is None:
+            return islice(materializer, offset, None)
+        return islice(materializer, offset, offset + self._limit)
 
 
 # XXX: Deprecated
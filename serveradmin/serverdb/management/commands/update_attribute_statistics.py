@@ -0,0 +1,53 @@
+from django.core.management.base import NoArgsCommand
+from django.db import connection, transaction
+
+from serveradmin.serverdb.models import (
+    Attribute,
+    AttributeStatistics,
+    ServerAttribute,
+)
+
+
+class Command(NoArgsCommand):
+    """Update the statistics of the attributes for planning the queries"""
+    help = __doc__
+
+    def handle_noargs(self, **kwargs):
+        statistics = []
+        with connection.cursor() as cursor:
+            for attribute_type in sorted({
+                a.type for a in Attribute.objects.all()
+                if not a.special and a.can_be_materialized()
+            }):
+                model = ServerAttribute.get_model(attribute_type)
+                cursor.execute(
+                    'SELECT'
+                    ' attribute_id,'
+                    ' count(DISTINCT server_id),'
+                    ' count(*),'
+                    ' {}'
+                    ' FROM {}'
+                    ' GROUP BY attribute_id'
+                    .format(
+                        # Boolean attributes are stored only when true.
+                        '1' if attribute_type == 'boolean'
+                        else 'count(DISTINCT value)',
+                        model._meta.db_table,
+                    )
+                )
+                for row in cursor.fetchall():
+                    statistics.append(AttributeStatistics(
+                        _attribute_id=row[0],
+                        num_servers=row[1],
+                        num_values=row[2],
+                        num_distinct_values=row[3],
+                    ))
+
+        with transaction.atomic():
+            AttributeStatistics.objects.get_queryset().delete()
+            AttributeStatistics.objects.bulk_create(statistics)
+        AttributeStatistics.objects._reset_cache()
+
+        self.stdout.write(
+            'Updated the statistics of {} attributes.'.format(len(statistics))
+        )
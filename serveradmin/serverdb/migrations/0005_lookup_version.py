@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [('serverdb', '0004_attribute_value_constraints')]
+    operations = [
+        migrations.RunSQL(
+            'CREATE TABLE lookup_version ('
+            '   version bigint NOT NULL'
+            ')'
+        ),
+        migrations.RunSQL('INSERT INTO lookup_version VALUES (0)'),
+        migrations.RunSQL(
+            'CREATE FUNCTION lookup_version_increment() '
+            'RETURNS trigger '
+            'LANGUAGE plpgsql '
+            'AS $$'
+            '   BEGIN'
+            '       UPDATE lookup_version SET version = version + 1;'
+            '       RETURN NULL;'
+            '   END'
+            '$$'
+        ),
+    ] + [
+        migrations.RunSQL(
+            'CREATE TRIGGER {0}_lookup_version '
+            'AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {0} '
+            'FOR EACH STATEMENT EXECUTE PROCEDURE lookup_version_increment()'
+            .format(table)
+        )
+        for table in ('project', 'servertype', 'attribute')
+    ]
@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [('serverdb', '0005_lookup_version')]
+    operations = [
+        migrations.RunSQL(
+            'CREATE TRIGGER servertype_attribute_lookup_version '
+            'AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE '
+            'ON servertype_attribute '
+            'FOR EACH STATEMENT EXECUTE PROCEDURE lookup_version_increment()'
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+    dependencies = [('serverdb', '0006_servertype_attribute_version')]
+    operations = [
+        migrations.CreateModel(
+            name='AttributeStatistics',
+            fields=[
+                ('_attribute', models.OneToOneField(
+                    primary_key=True,
+                    related_name='statistics',
+                    db_column='attribute_id',
+                    serialize=False,
+                    to='serverdb.Attribute',
+                    on_delete=django.db.models.deletion.CASCADE,
+                )),
+                ('num_servers', models.IntegerField()),
+                ('num_values', models.IntegerField()),
+                ('num_distinct_values', models.IntegerField()),
+                ('updated_on', models.DateTimeField(
+                    default=django.utils.timezone.now,
+                )),
+            ],
+            options={
+                'db_table': 'attribute_statistics',
+            },
+        ),
+    ]
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+    dependencies = [('serverdb', '0007_attribute_statistics')]
+    operations = [
+        migrations.RunSQL(
+            'CREATE TABLE data_version ('
+            '   servertype_id varchar(32) NOT NULL,'
+            '   attribute_id varchar(32) NOT NULL,'
+            '   version bigint NOT NULL,'
+            '   PRIMARY KEY (servertype_id, attribute_id)'
+            ')'
+        ),
+    ]
@@ -1,14 +1,16 @@
 import re
 import json
 
-from collections import OrderedDict
+from collections import defaultdict, OrderedDict
+from datetime import timedelta
 from distutils.util import strtobool
-from ipaddress import ip_address, ip_network
+from ipaddress import ip_address, ip_interface, ip_network
 from itertools import chain
+from threading import Lock
 
 from netaddr import EUI
 
-from django.db import models
+from django.db import connection, models
 from django.core.exceptions import ValidationError
 from django.core.signals import request_started
 from django.core.validators import RegexValidator
@@ -19,6 +21,7 @@ import netfields
 
 from adminapi.datatype import STR_BASED_DATATYPES
 from serveradmin.apps.models import Application
+from serveradmin.serverdb.radix_tree import RadixTree
 
 
 #
@@ -36,7 +39,7 @@ from serveradmin.apps.models import Application
 # The existing caching solutions for Django are quite complicated for
 # our need.  Here we are implementing a really basic Django Model
 # Manager to read all rows for a model on first time one of them is
-# accessed.
+# accessed.  The rows are kept until the lookup tables are changed.
 #
 # We are, on purpose, not trying to override all functions of
 # the manager.  Overriding the all() and get() methods are good enough
@@ -83,32 +86,74 @@ def get_choices(types):
     return zip(*([types] * 2))
 
 
+class LookupVersion(object):
+    """Track the version of the lookup tables on the database
+
+    The version is incremented by the triggers on the lookup tables in
+    the same transaction as the changes, so it cannot be seen before them.
+    It is fetched once in every request.
+    """
+    def __init__(self):
+        self.expire()
+        request_started.connect(self.expire)
+
+    def expire(self, **kwargs):
+        self._version = None
+
+    def get(self):
+        if self._version is None:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT version FROM lookup_version')
+                self._version = cursor.fetchone()[0]
+        return self._version
+
+
+lookup_version = LookupVersion()
+
+
 class LookupManager(models.Manager):
     """Custom Django model manager to cache lookup tables
 
     The purpose of this manager is to avoid accessing the lookup tables
-    multiple times.
+    multiple times.  The cache is kept across the requests.  It is checked
+    against the version of the lookup tables on the first access in every
+    request, and rebuilt only when they have changed.
     """
     def __init__(self):
         super(LookupManager, self).__init__()
+        self._lock = Lock()
+        self._lookup_dict = {}
         self._reset_cache()
-        # Make sure the cache is clean on every new request.
-        request_started.connect(self._reset_cache)
+        # Make sure the cache is checked on every new request.
+        request_started.connect(self._expire_cache)
 
     def _reset_cache(self, **kwargs):
-        self._cache_built = False
-        self._lookup_dict = {}
+        # The version has to be fetched again, because it might have been
+        # incremented by our own transaction which may still be rolled back.
+        lookup_version.expire()
+        self._cache_version = None
+        self._expire_cache()
+
+    def _expire_cache(self, **kwargs):
+        self._cache_checked = False
+
+    def _check_cache(self):
+        with self._lock:
+            version = lookup_version.get()
+            if self._cache_version != version:
+                self._lookup_dict = self._build_cache()
+                self._cache_version = version
+            self._cache_checked = True
 
     def _build_cache(self):
-        self._cache_built = True
-        self._lookup_dict = OrderedDict(
+        return OrderedDict(
             (o.pk, o) for o in super(LookupManager, self).all()
         )
 
     def all(self):
         """Override all method to cache all objects"""
-        if not self._cache_built:
-            self._build_cache()
+        if not self._cache_checked:
+            self._check_cache()
         return self._lookup_dict.values()
 
     def get(self, *args, **kwargs):
@@ -124,10 +169,9 @@ class LookupManager(models.Manager):
                 raise Exception(
                     'get() except "pk" are not supported on lookup models.'
                 )
+            if not self._cache_checked:
+                self._check_cache()
             if value not in self._lookup_dict:
-                if not self._cache_built:
-                    self._build_cache()
-                    return self.get(*args, **kwargs)
                 raise self.model.DoesNotExist(
                     '{} "{}" does not exist.'
                     .format(self.model.__name__, value)
@@ -226,9 +270,9 @@ class Servertype(LookupModel):
 
 class AttributeManager(LookupManager):
     def _build_cache(self):
-        super(AttributeManager, self)._build_cache()
-        self._lookup_dict = OrderedDict(chain(
-            Attribute.specials.items(), self._lookup_dict.items()
+        return OrderedDict(chain(
+            Attribute.specials.items(),
+            super(AttributeManager, self)._build_cache().items(),
         ))
 
 
@@ -287,9 +331,10 @@ class Attribute(LookupModel):
 
     @property
     def related_servertype_attributes(self):
-        return self.servertype_attributes.filter(
-            _related_via_attribute__isnull=False
-        )
+        return [
+            sa for sa in servertype_attribute_index.by_attribute(self)
+            if sa.related_via_attribute
+        ]
 
     def can_be_materialized(self):
         return bool(ServerAttribute.get_model(self.type))
@@ -439,14 +484,167 @@ class ServertypeAttribute(models.Model):
             self.regexp = None
         super(ServertypeAttribute, self).clean()
 
+    def save(self, *args, **kwargs):
+        super(ServertypeAttribute, self).save(*args, **kwargs)
+        servertype_attribute_index.reset()
+
+    def delete(self, *args, **kwargs):
+        super(ServertypeAttribute, self).delete(*args, **kwargs)
+        servertype_attribute_index.reset()
+
     @classmethod
     def query(self, servertypes=None, attributes=None):
-        queryset = self.objects
+        return servertype_attribute_index.query(servertypes, attributes)
+
+
+class ServertypeAttributeIndex(object):
+    """Cache the servertype attributes indexed in the ways we need them
+
+    The servertype attributes are not lookup models, but the table is
+    small, and it is needed by almost all of the queries and the commits.
+    We are keeping it in the process by servertype, by attribute and by
+    related via attribute.  It is invalidated the same way as the caches
+    of the lookup models.  The instances are kept with their compiled
+    regexps.
+    """
+    def __init__(self):
+        self._lock = Lock()
+        self._version = None
+        self._indexes = {}, {}, {}
+        self._checked = False
+        # Make sure the index is checked on every new request.
+        request_started.connect(self._expire)
+
+    def reset(self, **kwargs):
+        # See LookupManager._reset_cache()
+        lookup_version.expire()
+        self._version = None
+        self._expire()
+
+    def _expire(self, **kwargs):
+        self._checked = False
+
+    def _get_indexes(self):
+        if not self._checked:
+            with self._lock:
+                version = lookup_version.get()
+                if self._version != version:
+                    self._indexes = self._build()
+                    self._version = version
+                self._checked = True
+        return self._indexes
+
+    def _build(self):
+        by_servertype = defaultdict(OrderedDict)
+        by_attribute = defaultdict(list)
+        by_related_via_attribute = defaultdict(list)
+        for sa in ServertypeAttribute.objects.order_by('pk'):
+            by_servertype[sa._servertype_id][sa._attribute_id] = sa
+            by_attribute[sa._attribute_id].append(sa)
+            if sa._related_via_attribute_id:
+                by_related_via_attribute[
+                    sa._related_via_attribute_id
+                ].append(sa)
+
+        return (
+            dict(by_servertype),
+            dict(by_attribute),
+            dict(by_related_via_attribute),
+        )
+
+    def by_servertype(self, servertype):
+        """Get the servertype attributes of a servertype by attribute_id"""
+        return self._get_indexes()[0].get(servertype.pk, {})
+
+    def by_attribute(self, attribute):
+        return self._get_indexes()[1].get(attribute.pk, [])
+
+    def by_related_via_attribute(self, attribute):
+        return self._get_indexes()[2].get(attribute.pk, [])
+
+    def get(self, servertype, attribute):
+        try:
+            return self.by_servertype(servertype)[attribute.pk]
+        except KeyError:
+            raise ServertypeAttribute.DoesNotExist(
+                'Attribute "{}" is not on servertype "{}".'
+                .format(attribute, servertype)
+            )
+
+    def query(self, servertypes=None, attributes=None):
+        if attributes is None:
+            if servertypes is None:
+                servertypes = Servertype.objects.all()
+            return [
+                sa
+                for s in servertypes
+                for sa in self.by_servertype(s).values()
+            ]
+
+        servertype_ids = None
         if servertypes is not None:
-            queryset = queryset.filter(_servertype__in=servertypes)
-        if attributes is not None:
-            queryset = queryset.filter(_attribute__in=attributes)
-        return queryset
+            servertype_ids = {s.pk for s in servertypes}
+        return [
+            sa
+            for a in attributes
+            for sa in self.by_attribute(a)
+            if servertype_ids is None or sa._servertype_id in servertype_ids
+        ]
+
+
+servertype_attribute_index = ServertypeAttributeIndex()
+
+
+#
+# Attribute Statistics
+#
+# The SQL generator uses those to choose the order of the conditions.
+# They are updated by the "update_attribute_statistics" command.  We are
+# caching them like the lookup models, so they wouldn't cost anything
+# to the queries.  They are only hints, so they are not versioned with
+# the lookup models not to invalidate the caches depending on them.
+# The cache is reloaded after it gets old instead.
+#
+
+class StatisticsManager(LookupManager):
+    max_age = timedelta(minutes=10)
+
+    def _reset_cache(self, **kwargs):
+        self._built_on = None
+        self._expire_cache()
+
+    def _check_cache(self):
+        with self._lock:
+            if self._built_on is None or (
+                now() - self._built_on > self.max_age
+            ):
+                self._lookup_dict = self._build_cache()
+                self._built_on = now()
+            self._cache_checked = True
+
+
+class AttributeStatistics(LookupModel):
+    objects = StatisticsManager()
+
+    _attribute = models.OneToOneField(
+        Attribute,
+        primary_key=True,
+        related_name='statistics',
+        db_column='attribute_id',
+        on_delete=models.CASCADE,
+    )
+    attribute = Attribute.foreign_key_lookup('_attribute_id')
+    num_servers = models.IntegerField()
+    num_values = models.IntegerField()
+    num_distinct_values = models.IntegerField()
+    updated_on = models.DateTimeField(default=now)
+
+    class Meta:
+        app_label = 'serverdb'
+        db_table = 'attribute_statistics'
+
+    def get_servers_per_value(self):
+        return self.num_values / max(self.num_distinct_values, 1)
 
 
 #
@@ -488,10 +686,20 @@ class Server(models.Model):
         return self.hostname
 
     def get_supernet(self, servertype):
-        return Server.objects.get(
-            _servertype=servertype,
-            intern_ip__net_contains_or_equals=self.intern_ip,
-        )
+        # The index wouldn't include the changes of the current transaction.
+        if connection.in_atomic_block:
+            return Server.objects.get(
+                _servertype=servertype,
+                intern_ip__net_contains_or_equals=self.intern_ip,
+            )
+
+        supernet = network_index.get_supernet(servertype, self.intern_ip)
+        if supernet is None:
+            raise Server.DoesNotExist(
+                'No network of servertype "{}" contains "{}".'
+                .format(servertype, self.intern_ip)
+            )
+        return supernet
 
     def clean(self, *args, **kwargs):
         super(Server, self).clean(*args, **kwargs)
@@ -597,6 +805,101 @@ class Server(models.Model):
         server_attribute.save_value(value)
 
 
+class NetworkIndex(object):
+    """Index the servers of the network servertypes by their addresses
+
+    The networks are looked up a lot to find the supernets of the servers.
+    There are not too many of them, so we are keeping all of them in
+    the radix trees of their servertypes in the process across
+    the requests.  The index is checked on the first use in every request
+    against the data versions of the servertypes, and the trees of
+    the changed ones are rebuilt.  The trees keep the field values of
+    the servers, so every lookup returns a new instance.
+    """
+    # The versions of these attributes cover the fields of the servers.
+    # The creations and the deletions increment the "*" attribute.
+    versioned_attribute_ids = ('*', 'hostname', 'intern_ip', 'project')
+
+    def __init__(self):
+        self._lock = Lock()
+        self._trees = {}
+        self._versions = {}
+        self._checked = False
+        # Make sure the index is checked again on every new request.
+        request_started.connect(self.expire)
+
+    def expire(self, **kwargs):
+        self._checked = False
+
+    def get_supernet(self, servertype, intern_ip):
+        """Get the network of the servertype containing the address"""
+        if intern_ip is None:
+            return None
+        with self._lock:
+            if not self._checked:
+                self._update()
+            tree = self._trees.get(servertype.pk)
+            if tree is None:
+                return None
+            values = tree.get_longest_match(_get_network(intern_ip))
+        if values is None:
+            return None
+        return Server.from_db(connection.alias, _get_server_fields(), values)
+
+    def _update(self):
+        servertype_ids = [
+            s.pk for s in Servertype.objects.all()
+            if s.ip_addr_type == 'network'
+        ]
+        # The versions have to be selected before the servers, so that
+        # the changes in between are picked up next time.
+        versions = self._get_versions(servertype_ids)
+        self._trees = {
+            servertype_id: (
+                self._trees[servertype_id]
+                if self._versions.get(servertype_id) == version
+                else self._build(servertype_id)
+            )
+            for servertype_id, version in versions.items()
+        }
+        self._versions = versions
+        self._checked = True
+
+    def _get_versions(self, servertype_ids):
+        versions = dict.fromkeys(servertype_ids, 0)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT servertype_id, sum(version)'
+                ' FROM data_version'
+                ' WHERE servertype_id = ANY(%s) AND attribute_id = ANY(%s)'
+                ' GROUP BY servertype_id',
+                [servertype_ids, list(self.versioned_attribute_ids)],
+            )
+            versions.update(cursor.fetchall())
+        return versions
+
+    def _build(self, servertype_id):
+        tree = RadixTree()
+        for server in Server.objects.filter(
+            _servertype=servertype_id, intern_ip__isnull=False
+        ):
+            tree.insert(_get_network(server.intern_ip), tuple(
+                getattr(server, f) for f in _get_server_fields()
+            ))
+        return tree
+
+
+def _get_server_fields():
+    return [f.attname for f in Server._meta.concrete_fields]
+
+
+def _get_network(intern_ip):
+    return ip_interface(str(intern_ip)).network
+
+
+network_index = NetworkIndex()
+
+
 class ServerAttribute(models.Model):
     server = models.ForeignKey(
         Server,
@@ -0,0 +1,189 @@
+# The results of the queries are cached as the serialized JSON documents of
+# the servers.  The entries are validated by the versions of the data they
+# depend on.  The versions are counted on the database by servertype and
+# attribute, and incremented by the QueryCommitter in the same transaction
+# as the changes.  The creations and deletions of the servers increment
+# the version of their servertype with the "*" attribute.  The results which
+# include relations to the other servers depend on the "*" servertype with
+# the "*" attribute, because we cannot tell which servers they depend on.
+# Its version is the sum of all of the versions, so that it changes with
+# every commit without the commits locking the same row.
+#
+# The entries are kept in the local memory of the process with LRU
+# eviction, and they can also be shared through a Django cache configured
+# with the QUERY_CACHE setting.
+
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+
+from adminapi.request import json_encode_extra
+from serveradmin.serverdb.models import (
+    Attribute,
+    ServertypeAttribute,
+    lookup_version,
+)
+from serveradmin.serverdb.query_filterer import QueryFilterer
+
+MAX_CACHE_ENTRIES = 256
+# The larger results are not worth keeping in the memory
+MAX_CACHED_SERVERS = 10000
+ANY = '*'
+
+_local_cache = OrderedDict()
+_local_cache_lock = Lock()
+
+
+class CachedQuery(object):
+    """Look up and fill the cache for a single query
+
+    The versions are fetched on initialization, so the query has to be
+    executed after it.  This way the cached results cannot be older than
+    the versions.
+    """
+    def __init__(self, filters, restrict, order_by):
+        self._key = _get_cache_key(filters, restrict, order_by)
+        servertypes = QueryFilterer(filters).get_possible_servertypes()
+        self._versions = _get_data_versions(
+            get_dependencies(filters, restrict, order_by, servertypes)
+        )
+
+    def get_etag(self, representation):
+        """Return an entity tag for the HTTP responses of the results
+
+        It changes together with the versions the results depend on, so
+        the clients can be told that their results are still valid without
+        executing the query.
+        """
+        etag_json = json.dumps(
+            [self._key, sorted(self._versions.items()), representation]
+        )
+        return '"{}"'.format(sha1(etag_json.encode('utf8')).hexdigest())
+
+    def get(self):
+        """Return the cached documents, if they are still valid"""
+        with _local_cache_lock:
+            entry = _local_cache.get(self._key)
+            if entry is not None:
+                _local_cache.move_to_end(self._key)
+
+        shared_cache = _get_shared_cache()
+        if entry is None and shared_cache is not None:
+            entry = shared_cache.get(self._key)
+            if entry is not None:
+                _set_local(self._key, entry)
+
+        if entry is None or entry[0] != self._versions:
+            return None
+        return entry[1]
+
+    def set(self, documents):
+        if len(documents) > MAX_CACHED_SERVERS:
+            return
+
+        entry = (self._versions, documents)
+        _set_local(self._key, entry)
+        shared_cache = _get_shared_cache()
+        if shared_cache is not None:
+            shared_cache.set(self._key, entry)
+
+
+def increment_data_versions(keys):
+    """Increment the versions of the servertype and attribute pairs
+
+    This has to be called in the transaction of the changes.  The keys
+    are sorted to lock the rows always in the same order.
+    """
+    keys = sorted(set(keys))
+    if not keys:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO data_version (servertype_id, attribute_id, version)'
+            ' VALUES {}'
+            ' ON CONFLICT (servertype_id, attribute_id)'
+            ' DO UPDATE SET version = data_version.version + 1'
+            .format(', '.join(['(%s, %s, 1)'] * len(keys))),
+            [k for key in keys for k in key],
+        )
+
+
+def _get_cache_key(filters, restrict, order_by):
+    key_json = json.dumps(
+        [filters, restrict, order_by, lookup_version.get()],
+        default=json_encode_extra,
+        sort_keys=True,
+    )
+    return 'serveradmin_query:' + sha1(key_json.encode('utf8')).hexdigest()
+
+
+def get_dependencies(filters, restrict, order_by, servertypes):
+    """Return the servertype and attribute pairs the results depend on"""
+    if restrict is not None and not all(isinstance(r, str) for r in restrict):
+        # The joins depend on the other servers.
+        return {(ANY, ANY)}
+
+    attributes = set(filters)
+    attributes.update(order_by or [])
+    if restrict is not None:
+        attributes.update(restrict)
+    attributes = [Attribute.objects.get(pk=a) for a in attributes]
+    specials = [a for a in attributes if a.special]
+    if restrict is None:
+        specials = Attribute.specials.values()
+
+    dependencies = set()
+    for servertype in servertypes:
+        dependencies.add((servertype.pk, ANY))
+        dependencies.update((servertype.pk, a.pk) for a in specials)
+    for sa in ServertypeAttribute.query(
+        servertypes, None if restrict is None else attributes
+    ):
+        if sa.related_via_attribute or sa.attribute.type in (
+            'hostname', 'reverse_hostname', 'supernet'
+        ):
+            return {(ANY, ANY)}
+        dependencies.add((sa.servertype.pk, sa.attribute.pk))
+
+    return dependencies
+
+
+def _get_data_versions(dependencies):
+    versions = dict.fromkeys(dependencies, 0)
+    with connection.cursor() as cursor:
+        if (ANY, ANY) in versions:
+            cursor.execute('SELECT sum(version) FROM data_version')
+            versions[(ANY, ANY)] = int(cursor.fetchone()[0] or 0)
+        cursor.execute(
+            'SELECT servertype_id, attribute_id, version'
+            ' FROM data_version'
+            ' WHERE servertype_id = ANY(%s)',
+            [list({s for s, a in dependencies})],
+        )
+        for servertype_id, attribute_id, version in cursor:
+            if (servertype_id, attribute_id) in versions:
+                versions[(servertype_id, attribute_id)] = version
+    return versions
+
+
+def _get_shared_cache():
+    alias = getattr(settings, 'QUERY_CACHE', None)
+    if alias is None:
+        return None
+    return caches[alias]
+
+
+def _set_local(key, entry):
+    with _local_cache_lock:
+        _local_cache[key] = entry
+        _local_cache.move_to_end(key)
+        while len(_local_cache) > MAX_CACHE_ENTRIES:
+            _local_cache.popitem(last=False)
@@ -1,5 +1,6 @@
 import json
 from ipaddress import ip_network, ip_interface
+from itertools import chain
 
 from django.core.exceptions import PermissionDenied, ValidationError
 from django.db import IntegrityError, transaction
@@ -19,8 +20,12 @@ from serveradmin.serverdb.models import (
     ChangeUpdate,
     ChangeDelete,
     Project,
+    network_index,
+    servertype_attribute_index,
 )
+from serveradmin.serverdb.query_cache import ANY, increment_data_versions
 from serveradmin.serverdb.query_materializer import QueryMaterializer
+from serveradmin.serverdb.query_watcher import notify_watchers
 
 pre_commit = Signal()
 
@@ -56,7 +61,13 @@ class QueryCommitter:
             self._fetch()
             self._validate()
             self._apply()
-            self._log_changes()
+            commit = self._log_changes()
+            keys = self._get_changed_keys()
+            increment_data_versions(keys)
+            notify_watchers(commit.id, self._get_changed_object_ids(), keys)
+
+        # The networks may have been changed by the commit.
+        network_index.expire()
 
         if self.warnings:
             warnings = '\n'.join(self.warnings)
@@ -167,6 +178,30 @@ class QueryCommitter:
                 attributes_json=attributes_json,
             )
 
+        return commit
+
+    def _get_changed_keys(self):
+        """Return the servertype and attribute pairs changed by the commit"""
+        keys = set()
+        for obj in chain(
+            self._created_objects.values(), self._deleted_objects.values()
+        ):
+            keys.add((obj['servertype'], ANY))
+        for changes in self.changed:
+            servertype = self._changed_servers[changes['object_id']].servertype
+            keys.update(
+                (servertype.pk, a) for a in changes if a != 'object_id'
+            )
+
+        return keys
+
+    def _get_changed_object_ids(self):
+        return set(chain(
+            self._created_objects,
+            self._changed_objects,
+            self._deleted_objects,
+        ))
+
     def _apply(self):
         # Changes should be applied in order to prevent integrity errors.
         self._delete_attributes()
@@ -437,13 +472,12 @@ def _materialize_servers(servers):
 
 
 def _get_servertype_attributes(servers):
-    servertype_attributes = dict()
-    for servertype_id in {s['servertype'] for s in servers.values()}:
-        servertype_attributes[servertype_id] = dict()
-        for sa in Servertype.objects.get(pk=servertype_id).attributes.all():
-            servertype_attributes[servertype_id][sa.attribute.pk] = sa
-
-    return servertype_attributes
+    return {
+        servertype_id: servertype_attribute_index.by_servertype(
+            Servertype.objects.get(pk=servertype_id)
+        )
+        for servertype_id in {s['servertype'] for s in servers.values()}
+    }
 
 
 def _validate_attributes(changes, servers, servertype_attributes):
@@ -743,7 +777,7 @@ def _validate_real_attributes(servertype, real_attributes):     # NOQA: C901
     violations_regexp = []
     violations_required = []
     servertype_attributes = set()
-    for sa in servertype.attributes.all():
+    for sa in servertype_attribute_index.by_servertype(servertype).values():
         attribute = sa.attribute
         servertype_attributes.add(attribute)
 
@@ -1,4 +1,9 @@
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from itertools import count
+from re import compile as re_compile
+from weakref import WeakKeyDictionary
+
+from django.db import DEFAULT_DB_ALIAS, connection, connections
 
 from serveradmin.serverdb.models import (
     Attribute,
@@ -6,12 +11,42 @@ from serveradmin.serverdb.models import (
     ServertypeAttribute,
     Server,
 )
-from serveradmin.serverdb.sql_generator import get_server_query
+from serveradmin.serverdb.sql_generator import (
+    get_server_query,
+    get_server_count_query,
+)
+
+# PostgreSQL keeps the prepared statements for the lifetime of the session,
+# so we have to remember them per database connection.  The statements are
+# keyed by the generated SQL which only depends on the shape of the filters
+# (the attributes and the filter classes) but not on their values.  We are
+# limiting the number of statements kept per connection, and deallocate
+# the least recently used ones.
+MAX_PREPARED_STATEMENTS = 256
+
+_prepared_statements = WeakKeyDictionary()
+_prepared_statement_ids = count()
+_placeholder_re = re_compile(r'%[s%]')
 
 
 class QueryFilterer(object):
-    def __init__(self, filters):
+    def __init__(
+        self,
+        filters,
+        order_by=None,
+        limit=None,
+        offset=None,
+        after_hostname=None,
+        server_ids=None,
+    ):
+        self._order_by = [Attribute.objects.get(pk=a) for a in order_by or []]
+        self._limit = limit
+        self._offset = offset
+        self._after_hostname = after_hostname
+        self._server_ids = server_ids
+
         # We can just deal with the servertype filter ourself.
+        filters = dict(filters)
         if 'servertype' in filters:
             servertype_filt = filters.pop('servertype')
         else:
@@ -36,24 +71,128 @@ class QueryFilterer(object):
         # If there are no possible matches, there is no need to make
         # a database query.
         if self._possible_servertypes:
-            result = Server.objects.raw(get_server_query(
-                self._possible_servertypes, self._attribute_filters
-            ))
+            sql, params = self.get_sql()
+            result = Server.objects.raw(*_execute_prepared(sql, params))
         else:
             result = []
 
         return iter(result)
 
+    def get_possible_servertypes(self):
+        return list(self._possible_servertypes)
+
+    def get_sql(self):
+        """Return the SQL and the parameters of the query"""
+        return get_server_query(
+            self._possible_servertypes,
+            self._attribute_filters,
+            self._order_by,
+            self._limit,
+            self._offset,
+            self._after_hostname,
+            self._server_ids,
+        )
+
+    def explain(self):
+        """Return the lines of the plan of the query with the statistics
+
+        The query is executed by the database once more to collect them.
+        """
+        if not self._possible_servertypes:
+            return []
+
+        sql, params = _execute_prepared(*self.get_sql())
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS) ' + sql, params)
+            return [r[0] for r in cursor]
+
+    def count(self):
+        """Return the number of the matching servers ignoring the limit"""
+        if not self._possible_servertypes:
+            return 0
+
+        sql, params = get_server_count_query(
+            self._possible_servertypes, self._attribute_filters
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(*_execute_prepared(sql, params))
+            return cursor.fetchone()[0]
+
+
+def can_order_by(attribute_ids):
+    """Check whether the servers can be ordered by the database
+
+    We can order only by the special attributes and the single value
+    attributes which are stored on the servers themselves.  The others
+    have to be sorted after materialization.
+    """
+    for attribute_id in attribute_ids:
+        attribute = Attribute.objects.get(pk=attribute_id)
+        if attribute.special:
+            continue
+        if attribute.multi or not attribute.can_be_materialized():
+            return False
+        if attribute.related_servertype_attributes:
+            return False
+
+    return True
+
 
 def _get_possible_servertypes(attributes):
     servertypes = set(Servertype.objects.all())
 
     if attributes:
         attribute_servertypes = defaultdict(set)
-        for sa in ServertypeAttribute.query(attributes=attributes).all():
+        for sa in ServertypeAttribute.query(attributes=attributes):
             attribute_servertypes[sa.attribute].add(sa.servertype)
 
         for new in attribute_servertypes.values():
             servertypes = servertypes.intersection(new)
 
     return servertypes
+
+
+def _execute_prepared(sql, params):
+    """Prepare the statement, if necessary, and return the SQL to execute it
+    """
+    db = connections[DEFAULT_DB_ALIAS]
+
+    # Getting the cursor ensures the connection.  A new connection would
+    # not have any statements, and the ones of the old connections would
+    # go away with them.
+    with db.cursor() as cursor:
+        statements = _prepared_statements.setdefault(
+            db.connection, OrderedDict()
+        )
+        if sql in statements:
+            statement_name = statements.pop(sql)
+        else:
+            if len(statements) >= MAX_PREPARED_STATEMENTS:
+                old_sql, old_name = statements.popitem(last=False)
+                cursor.execute('DEALLOCATE ' + old_name)
+
+            statement_name = 'serveradmin_query_{}'.format(
+                next(_prepared_statement_ids)
+            )
+            cursor.execute('PREPARE {} AS {}'.format(
+                statement_name, _get_native_placeholders(sql)
+            ))
+        statements[sql] = statement_name
+
+    if not params:
+        return 'EXECUTE ' + statement_name, params
+    return 'EXECUTE {} ({})'.format(
+        statement_name, ', '.join(['%s'] * len(params))
+    ), params
+
+
+def _get_native_placeholders(sql):
+    """Convert the placeholders of the driver to the ones of PostgreSQL"""
+    numbers = count(1)
+
+    def replace(match):
+        if match.group() == '%%':
+            return '%'
+        return '${}'.format(next(numbers))
+
+    return _placeholder_re.sub(replace, sql)
@@ -0,0 +1,138 @@
+# The QueryMaterializer builds Python objects for the servers which are
+# serialized to JSON again on the API.  For the read-only queries, we can
+# let PostgreSQL build the same JSON documents instead, and just pass them
+# through.  This only supports the attributes stored on the servers
+# themselves, so the callers need to check it with can_materialize_json()
+# first.
+
+from django.db import connection
+
+from serveradmin.serverdb.models import (
+    Attribute,
+    ServertypeAttribute,
+    ServerAttribute,
+)
+
+# PostgreSQL functions cannot take more than 100 arguments, so we have to
+# build the objects in parts.
+MAX_OBJECT_PAIRS = 50
+
+
+class QueryJSONMaterializer(object):
+    def __init__(self, servers, restrict):
+        self._servers = list(servers)
+        self._attributes = _get_restricted_attributes(restrict)
+
+    def __iter__(self):
+        if not self._servers:
+            return
+
+        servertypes = {s.servertype for s in self._servers}
+        sql = (
+            'SELECT (CASE server.servertype_id {} END)::text'
+            ' FROM unnest(%s::int[]) WITH ORDINALITY AS ids(server_id, pos)'
+            ' JOIN server ON server.server_id = ids.server_id'
+            ' ORDER BY ids.pos'
+            .format(' '.join(
+                "WHEN '{}' THEN {}".format(
+                    s.pk, self._get_object_sql(s)
+                )
+                for s in servertypes
+            ))
+        )
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [[s.server_id for s in self._servers]])
+            for row in cursor:
+                yield row[0]
+
+    def _get_object_sql(self, servertype):
+        pairs = [("'object_id'", 'server.server_id')]
+        for attribute_id in ('hostname', 'servertype', 'project'):
+            attribute = Attribute.specials[attribute_id]
+            if self._attributes is None or attribute in self._attributes:
+                field = attribute.special.field
+                if field.startswith('_'):
+                    field = field[1:]
+                pairs.append((
+                    "'{}'".format(attribute_id), 'server.' + field
+                ))
+        intern_ip = Attribute.specials['intern_ip']
+        if self._attributes is None or intern_ip in self._attributes:
+            pairs.append(("'intern_ip'", _get_inet_sql(
+                servertype, 'server.intern_ip'
+            )))
+
+        for sa in ServertypeAttribute.query((servertype, ), self._attributes):
+            pairs.append((
+                "'{}'".format(sa.attribute.pk),
+                _get_attribute_sql(servertype, sa.attribute),
+            ))
+
+        return ' || '.join(
+            'json_build_object({})::jsonb'.format(', '.join(
+                k + ', ' + v for k, v in pairs[i:(i + MAX_OBJECT_PAIRS)]
+            ))
+            for i in range(0, len(pairs), MAX_OBJECT_PAIRS)
+        )
+
+
+def can_materialize_json(servertypes, restrict):
+    """Check whether the servers can be materialized on the database"""
+    if restrict is not None and not all(isinstance(r, str) for r in restrict):
+        return False
+
+    attributes = _get_restricted_attributes(restrict)
+    for sa in ServertypeAttribute.query(servertypes, attributes):
+        if sa.related_via_attribute:
+            return False
+        if not sa.attribute.can_be_materialized():
+            return False
+
+    return True
+
+
+def _get_restricted_attributes(restrict):
+    if restrict is None:
+        return None
+    return [Attribute.objects.get(pk=a) for a in restrict]
+
+
+def _get_attribute_sql(servertype, attribute):
+    table = ServerAttribute.get_model(attribute.type)._meta.db_table
+    from_sql = '{} AS sub'.format(table)
+    condition = (
+        "sub.server_id = server.server_id AND sub.attribute_id = '{}'"
+        .format(attribute.pk)
+    )
+    if attribute.type == 'boolean':
+        return 'EXISTS (SELECT 1 FROM {} WHERE {})'.format(from_sql, condition)
+
+    if attribute.type == 'hostname':
+        from_sql += ' JOIN server AS target ON target.server_id = sub.value'
+        value = 'target.hostname'
+    elif attribute.type == 'inet':
+        value = _get_inet_sql(servertype, 'sub.value')
+    elif attribute.type == 'macaddr':
+        value = 'sub.value::text'
+    elif attribute.type == 'date':
+        value = "to_char(sub.value, 'YYYY-MM-DD')"
+    else:
+        value = 'sub.value'
+
+    if attribute.multi:
+        return (
+            "COALESCE((SELECT json_agg({}) FROM {} WHERE {}), '[]'::json)"
+            .format(value, from_sql, condition)
+        )
+    return '(SELECT {} FROM {} WHERE {} LIMIT 1)'.format(
+        value, from_sql, condition
+    )
+
+
+def _get_inet_sql(servertype, column):
+    # The addresses are formatted by the IP address type of the servertype
+    # the same way as the QueryMaterializer does.
+    if servertype.ip_addr_type == 'network':
+        return 'network({})::text'.format(column)
+    return 'host({})'.format(column)
@@ -3,10 +3,13 @@
 # a good idea to refactor this by using more top level functions instead of
 # object methods.
 
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from decimal import Decimal
 from ipaddress import IPv4Address, IPv6Address
+from time import time
 
 from django.core.exceptions import ValidationError
+from django.db import connection
 
 from adminapi.dataset import DatasetObject
 from serveradmin.serverdb.models import (
@@ -17,12 +20,16 @@ from serveradmin.serverdb.models import (
     Server,
     ServerAttribute,
     ServerHostnameAttribute,
+    network_index,
+    servertype_attribute_index,
 )
 
 
 class QueryMaterializer:
     def __init__(self, servers, restrict, order_by=None):
         self._servers = list(servers)
+        # The durations of the phases for explaining the queries
+        self.timings = OrderedDict()
         self._order_by = [Attribute.objects.get(pk=a) for a in order_by or []]
 
         if restrict is None:
@@ -57,7 +64,9 @@ class QueryMaterializer:
         self._select_attributes(servers_by_type.keys())
         self._initialize_attributes(servers_by_type)
         self._add_attributes(servers_by_type)
+        start = time()
         self._add_related_attributes(servers_by_type)
+        self.timings['related'] = time() - start
 
     def __iter__(self):
         servers = self._servers
@@ -70,7 +79,9 @@ class QueryMaterializer:
 
             servers = sorted(servers, key=order_by_key)
 
+        start = time()
         join_results = self._get_join_results()
+        self.timings['joins'] = time() - start
         return (
             DatasetObject(self._get_attributes(s, join_results))
             for s in servers
@@ -97,9 +108,11 @@ class QueryMaterializer:
             # to add the relations in there, too.  We are going to use
             # those to query the related attributes.
             if self._attributes is not None:
-                self._select_servertype_attribute(ServertypeAttribute.query(
-                    (sa.servertype, ), (related_via_attribute, )
-                ).get())
+                self._select_servertype_attribute(
+                    servertype_attribute_index.get(
+                        sa.servertype, related_via_attribute
+                    )
+                )
 
     def _initialize_attributes(self, servers_by_type):
         for attribute, servertypes in self._servertypes_by_attribute.items():
@@ -110,7 +123,9 @@ class QueryMaterializer:
 
     def _add_attributes(self, servers_by_type):
         """Add the attributes to the results"""
+        stored_attributes = []
         for key, attributes in self._attributes_by_type.items():
+            start = time()
             if key == 'supernet':
                 for attribute in attributes:
                     self._add_supernet_attribute(attribute, (
@@ -129,41 +144,110 @@ class QueryMaterializer:
                         sa.value, reversed_attributes[sa.attribute], sa.server
                     )
             else:
-                for sa in ServerAttribute.get_model(key).objects.filter(
-                    server__in=self._server_attributes.keys(),
-                    _attribute__in=attributes,
-                ).select_related('server'):
-                    self._add_attribute_value(
-                        sa.server, sa.attribute, sa.get_value()
-                    )
+                stored_attributes.extend(attributes)
+                continue
+            self.timings[key] = time() - start
+
+        if stored_attributes and self._servers:
+            start = time()
+            self._add_stored_attributes(stored_attributes)
+            self.timings['stored'] = time() - start
+
+    def _add_stored_attributes(self, attributes):
+        """Add the attributes stored on the servers with a single query
+
+        The values are selected as text from all of the attribute tables
+        and converted to the Python types the same way as the models would.
+        This avoids a query for every attribute type, and instantiating
+        a model for every value.
+        """
+        servers_by_id = {s.server_id: s for s in self._servers}
+        converters = {
+            a.pk: (a, _get_value_converter(a.type)) for a in attributes
+        }
+        sql = (
+            'SELECT sub.server_id, sub.attribute_id, sub.value'
+            ' FROM ({}) AS sub'
+            ' WHERE sub.server_id = ANY(%s) AND sub.attribute_id = ANY(%s)'
+            .format(' UNION ALL '.join(
+                _get_attribute_value_sql(t)
+                for t in sorted({a.type for a in attributes})
+            ))
+        )
+
+        # We need the servers to add as the values of the hostname
+        # attributes.  They are fetched after all the others.
+        hostname_values = []
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [
+                list(servers_by_id.keys()), list(converters.keys())
+            ])
+            for server_id, attribute_id, value in cursor:
+                attribute, converter = converters[attribute_id]
+                server = servers_by_id[server_id]
+                value = converter(value)
+                if attribute.type == 'hostname':
+                    hostname_values.append((server, attribute, value))
+                else:
+                    self._add_attribute_value(server, attribute, value)
+
+        if hostname_values:
+            targets = Server.objects.in_bulk(
+                {v for s, a, v in hostname_values}
+            )
+            for server, attribute, value in hostname_values:
+                self._add_attribute_value(server, attribute, targets[value])
 
     def _add_related_attributes(self, servers_by_type):
         for servertype_attribute in self._related_servertype_attributes:
             self._add_related_attribute(servertype_attribute, servers_by_type)
 
     def _add_supernet_attribute(self, attribute, servers):
-        """Merge-join networks to the servers
+        """Join the networks to the servers
 
-        This function takes advantage of networks in the same servertype not
-        overlapping with each other.
+        Networks in the same servertype are not overlapping with each other,
+        so a server can have only one.  They are looked up on the network
+        index, unless we are in a transaction which may have changed them.
         """
-        target = None
-        for source in sorted(servers, key=lambda s: _sort_key(s.intern_ip)):
-            # Check the previous target
-            if target is not None:
-                network = target.intern_ip.network
-                if network.version != source.intern_ip.version:
-                    target = None
-                elif network.broadcast_address < source.intern_ip.ip:
-                    target = None
-                elif source.intern_ip not in network:
-                    continue
-            # Check for a new target
-            if target is None:
-                try:
-                    target = source.get_supernet(attribute.target_servertype)
-                except Server.DoesNotExist:
-                    continue
+        servertype = attribute.target_servertype
+        if not connection.in_atomic_block:
+            for server in servers:
+                supernet = network_index.get_supernet(
+                    servertype, server.intern_ip
+                )
+                if supernet is not None:
+                    self._server_attributes[server][attribute] = supernet
+            return
+
+        # The query can use the GiST index of the exclusion constraint on
+        # the addresses of the servers.  We are inlining the servertype for
+        # the partial index to be considered.
+        servers_by_id = {
+            s.server_id: s for s in servers if s.intern_ip is not None
+        }
+        if not servers_by_id:
+            return
+
+        targets = {}
+        for target in Server.objects.raw(
+            'SELECT'
+            ' supernet.server_id,'
+            ' supernet.hostname,'
+            ' supernet.intern_ip,'
+            ' supernet.servertype_id AS _servertype_id,'
+            ' supernet.project_id AS _project_id,'
+            ' server.server_id AS source_id'
+            ' FROM server'
+            ' JOIN server AS supernet'
+            '   ON supernet.intern_ip >>= server.intern_ip'
+            " WHERE supernet.servertype_id = '{}'"
+            '   AND server.server_id = ANY(%s)'
+            .format(servertype.pk),
+            [list(servers_by_id.keys())],
+        ):
+            # Use the same object for all of the servers in the network
+            source = servers_by_id[target.source_id]
+            target = targets.setdefault(target.server_id, target)
             self._server_attributes[source][attribute] = target
 
     def _add_related_attribute(self, servertype_attribute, servers_by_type):
@@ -293,6 +377,38 @@ def _sort_key(value):
     return value
 
 
+def _get_attribute_value_sql(attribute_type):
+    table = ServerAttribute.get_model(attribute_type)._meta.db_table
+    if attribute_type == 'boolean':
+        value = 'NULL::text'
+    else:
+        value = 'value::text'
+
+    return 'SELECT server_id, attribute_id, {} AS value FROM {}'.format(
+        value, table
+    )
+
+
+def _get_value_converter(attribute_type):
+    """Return the function to convert the value from text"""
+    if attribute_type == 'boolean':
+        return lambda value: True
+    if attribute_type == 'number':
+        return _get_number
+    if attribute_type == 'hostname':
+        return int
+
+    model = ServerAttribute.get_model(attribute_type)
+    return model._meta.get_field('value').to_python
+
+
+def _get_number(value):
+    value = Decimal(value)
+    if value.as_tuple().exponent == 0:
+        return int(value)
+    return float(value)
+
+
 def get_default_attribute_values(servertype_id):
     servertype = Servertype.objects.get(pk=servertype_id)
     attribute_values = {}
@@ -306,7 +422,7 @@ def get_default_attribute_values(servertype_id):
             value = None
         attribute_values[attribute_id] = value
 
-    for sa in servertype.attributes.all():
+    for sa in servertype_attribute_index.by_servertype(servertype).values():
         attribute_values[sa.attribute.pk] = sa.get_default_value()
 
     return attribute_values
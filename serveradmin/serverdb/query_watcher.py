@@ -0,0 +1,93 @@
+# The QueryCommitter notifies the commits on a PostgreSQL channel with
+# the servertype and attribute pairs they changed, the same keys as
+# the versions of the query cache.  The watchers listen to the channel, and
+# wake up only for the commits that changed any of the keys their query
+# depends on.  The notifications are sent by PostgreSQL when
+# the transaction is committed, so the changes are already visible to
+# the watchers.
+
+from select import select
+from time import time
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from django.db import connection
+
+from serveradmin.serverdb.query_cache import ANY, get_dependencies
+from serveradmin.serverdb.query_filterer import QueryFilterer
+
+CHANNEL = 'serverdb_commit'
+# PostgreSQL doesn't accept longer payloads.
+MAX_PAYLOAD_LENGTH = 7999
+
+
+class QueryWatcher(object):
+    """Wait for the commits affecting the results of a query
+
+    It has to be used as a context manager outside of a transaction to
+    listen to the channel.
+    """
+    def __init__(self, filters, restrict):
+        servertypes = QueryFilterer(filters).get_possible_servertypes()
+        self._dependencies = get_dependencies(
+            filters, restrict, None, servertypes
+        )
+
+    def __enter__(self):
+        with connection.cursor() as cursor:
+            cursor.execute('LISTEN ' + CHANNEL)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with connection.cursor() as cursor:
+            cursor.execute('UNLISTEN ' + CHANNEL)
+
+    def wait(self, timeout):
+        """Return whether an affecting commit is notified until timeout"""
+        pg_connection = connection.connection
+        deadline = time() + timeout
+        while True:
+            # The notifications may already be received while the other
+            # queries are executed on the connection after LISTEN.
+            pg_connection.poll()
+            notifies = pg_connection.notifies[:]
+            del pg_connection.notifies[:]
+            if any(self._is_affected(json.loads(n.payload)) for n in notifies):
+                return True
+
+            remaining = deadline - time()
+            if remaining <= 0:
+                return False
+            if not select([pg_connection], [], [], remaining)[0]:
+                return False
+
+    def _is_affected(self, payload):
+        # The keys are left out, when the commit is too large.
+        if payload['keys'] is None:
+            return True
+        return any(tuple(k) in self._dependencies for k in payload['keys'])
+
+
+def notify_watchers(commit_id, object_ids, keys):
+    """Notify the changes of a commit to the watchers
+
+    This has to be called in the transaction of the changes.  The object
+    ids and then the keys are left out, if the payload is too long.
+    """
+    # Every commit changes the data of the joins as well.
+    payload = {
+        'commit_id': commit_id,
+        'object_ids': sorted(object_ids),
+        'keys': sorted(set(keys) | {(ANY, ANY)}),
+    }
+    for field in ('object_ids', 'keys'):
+        if len(json.dumps(payload)) <= MAX_PAYLOAD_LENGTH:
+            break
+        payload[field] = None
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT pg_notify(%s, %s)', [CHANNEL, json.dumps(payload)]
+        )
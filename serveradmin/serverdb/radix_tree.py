@@ -0,0 +1,58 @@
+class RadixTree(object):
+    """Binary radix tree to look up the networks containing others
+
+    The networks are stored on the nodes reached by following the bits
+    of their addresses up to their prefix lengths.  All of the networks
+    containing a given one are on the path from the root to it, so they
+    can be found without comparing to any other network.  IPv4 and IPv6
+    networks are kept in separate trees.
+    """
+
+    def __init__(self):
+        self._roots = {}
+
+    def insert(self, network, value):
+        node = self._roots.setdefault(network.version, _Node())
+        for bit in _iter_bits(network):
+            if node.children[bit] is None:
+                node.children[bit] = _Node()
+            node = node.children[bit]
+        node.network = network
+        node.value = value
+
+    def get_longest_match(self, network, default=None):
+        """Get the value of the smallest network containing the given"""
+        for match, value in self.iter_matches(network):
+            default = value
+        return default
+
+    def iter_matches(self, network):
+        """Iterate the networks containing the given from the largest"""
+        node = self._roots.get(network.version)
+        bits = _iter_bits(network)
+        while node is not None:
+            if node.network is not None:
+                yield node.network, node.value
+            bit = next(bits, None)
+            if bit is None:
+                break
+            node = node.children[bit]
+
+
+class _Node(object):
+    __slots__ = ('children', 'network', 'value')
+
+    def __init__(self):
+        self.children = [None, None]
+        self.network = None
+        self.value = None
+
+
+def _iter_bits(network):
+    address = int(network.network_address)
+    for shift in range(
+        network.max_prefixlen - 1,
+        network.max_prefixlen - network.prefixlen - 1,
+        -1,
+    ):
+        yield (address >> shift) & 1
@@ -1,5 +1,14 @@
-# XXX: It is terrible to generate SQL this way.  We should make this use
-# parameterized queries at least.
+# The generated SQL uses "%s" placeholders for all of the filter values.
+# The identifiers of the servertypes and the attributes are still inlined,
+# because they are validated and they belong to the shape of the query.
+# The same shape of filters therefore results in the same SQL which lets
+# the caller reuse the prepared statements.
+#
+# The conditions are ordered by the number of servers they are estimated to
+# match using the statistics of the attributes.  The planner of PostgreSQL
+# cannot estimate the correlated subqueries on our entity-attribute-value
+# tables well, so we are helping it by choosing the form of the most
+# selective condition ourselves.
 
 from adminapi.filters import (
     All,
@@ -20,15 +29,39 @@ from adminapi.filters import (
     StartsWith,
     Not,
 )
-from serveradmin.serverdb.models import ServerAttribute
-
-
-def get_server_query(servertypes, attribute_filters):
-    # If there are no possible matches, there is no need to make
-    # a database query.
-    if not servertypes:
-        return []
+from serveradmin.serverdb.models import (
+    AttributeStatistics,
+    ServerAttribute,
+    ServertypeAttribute,
+)
 
+# The most selective condition is used to drive the query, if it is
+# estimated to match less servers than this
+MAX_DRIVING_SERVERS = 10000
+
+
+def get_server_query(
+    servertypes,
+    attribute_filters,
+    order_by=(),
+    limit=None,
+    offset=None,
+    after_hostname=None,
+    server_ids=None,
+):
+    """Return the SQL and the parameters to select the matching servers
+
+    The servers after the given hostname can be selected for keyset
+    pagination.  Hostnames are unique, so they are enough to identify
+    the position on the default order.  The servers can also be limited to
+    the given ids which are passed as a single array parameter to keep
+    the same SQL for any number of them.
+    """
+    params = []
+    joins, condition = _get_server_filter(
+        servertypes, attribute_filters, params
+    )
+    order_by_joins, order_by_sql = _get_order_by_sql(servertypes, order_by)
     sql = (
         'SELECT'
         ' server.server_id,'
@@ -36,29 +69,275 @@ def get_server_query(servertypes, attribute_filters):
         ' server.intern_ip,'
         ' server.servertype_id AS _servertype_id,'
         ' server.project_id AS _project_id'
-        ' FROM server'
-        ' WHERE servertype_id IN ({})'
-        .format(', '.join(
-            '\'{}\''.format(s.pk) for s in servertypes)
-        )
+        ' FROM server' +
+        ''.join(joins + order_by_joins) +
+        ' WHERE ' +
+        condition
+    )
+
+    if server_ids is not None:
+        sql += ' AND server.server_id = ANY(%s)'
+        params.append(list(server_ids))
+
+    if after_hostname is not None:
+        assert not order_by
+        sql += ' AND server.hostname > %s'
+        params.append(after_hostname)
+
+    sql += (
+        ' ORDER BY ' +
+        ''.join(o + ', ' for o in order_by_sql) +
+        'server.hostname, server.intern_ip, server.server_id'
+    )
+
+    if limit is not None:
+        sql += ' LIMIT %s'
+        params.append(limit)
+    if offset:
+        sql += ' OFFSET %s'
+        params.append(offset)
+
+    return sql, params
+
+
+def get_server_count_query(servertypes, attribute_filters):
+    """Return the SQL and the parameters to count the matching servers"""
+    params = []
+    joins, condition = _get_server_filter(
+        servertypes, attribute_filters, params
+    )
+    sql = (
+        'SELECT COUNT(*) FROM server' + ''.join(joins) + ' WHERE ' + condition
     )
 
+    return sql, params
+
+
+def _get_server_filter(servertypes, attribute_filters, params):
+    """Return the joins and the condition to filter the servers
+
+    The most selective condition is turned into a join, or into
+    an uncorrelated IN subquery for the multi attributes, when it is
+    estimated to match few enough servers.  The others are left as
+    EXISTS subqueries in the order of their selectivity.
+    """
+    # The callers should avoid the database query, if there are no
+    # possible matches.
+    assert servertypes
+
+    estimated_filters = []
     for attribute, filt in attribute_filters:
         assert isinstance(filt, BaseFilter)
 
-        sql += ' AND ' + _get_sql_condition(servertypes, attribute, filt)
+        estimated_filters.append((
+            _estimate_servers(servertypes, attribute, filt), attribute, filt
+        ))
+    # Sort the filters we couldn't estimate to the end keeping their order
+    estimated_filters.sort(key=lambda f: (f[0] is None, f[0] or 0))
+
+    joins = []
+    conditions = ['server.servertype_id IN ({})'.format(
+        ', '.join('\'{}\''.format(s.pk) for s in servertypes)
+    )]
+    if estimated_filters:
+        estimate, attribute, filt = estimated_filters[0]
+        if (
+            estimate is not None and
+            estimate <= MAX_DRIVING_SERVERS and
+            _can_drive(attribute, filt)
+        ):
+            template = _get_driving_template(attribute, filt, params)
+            table = ServerAttribute.get_model(attribute.type)._meta.db_table
+            driving_condition = (
+                "driving.attribute_id = '{}' AND {}"
+                .format(attribute.pk, template.format('driving.value'))
+            )
+            if attribute.multi:
+                # The servers can have multiple matching values.
+                conditions.append(
+                    'server.server_id IN ('
+                    '   SELECT driving.server_id'
+                    '   FROM {} AS driving'
+                    '   WHERE {}'
+                    ')'
+                    .format(table, driving_condition)
+                )
+            else:
+                joins.append(
+                    ' JOIN {} AS driving'
+                    '   ON driving.server_id = server.server_id AND {}'
+                    .format(table, driving_condition)
+                )
+            del estimated_filters[0]
+
+    for estimate, attribute, filt in estimated_filters:
+        conditions.append(_get_sql_condition(
+            servertypes, attribute, filt, params
+        ))
+
+    return joins, ' AND '.join(conditions)
+
 
-    sql += ' ORDER BY server.hostname, server.intern_ip, server.server_id'
+def _estimate_servers(servertypes, attribute, filt):    # NOQA: C901
+    """Estimate the number of servers the filter would match
 
-    return sql
+    None is returned, if we cannot tell.
+    """
+    if attribute.special:
+        if attribute.special.unique and type(filt) == BaseFilter:
+            return 1
+        return None
+
+    if isinstance(filt, All):
+        estimates = [
+            e for e in (
+                _estimate_servers(servertypes, attribute, v)
+                for v in filt.values
+            )
+            if e is not None
+        ]
+        return min(estimates) if estimates else None
+    if isinstance(filt, Any):
+        estimates = [
+            _estimate_servers(servertypes, attribute, v) for v in filt.values
+        ]
+        return None if None in estimates else sum(estimates)
+
+    # The negated filters are matching the servers without the attribute.
+    if isinstance(filt, (Not, Empty)):
+        return None
+    if attribute.type == 'boolean' and (
+        not filt.value or filt.value == 'false'
+    ):
+        return None
+
+    # The statistics are about the values on the servers themselves.
+    if any(
+        sa.related_via_attribute
+        for sa in ServertypeAttribute.query(servertypes, (attribute, ))
+    ):
+        return None
+
+    try:
+        statistics = AttributeStatistics.objects.get(pk=attribute.pk)
+    except AttributeStatistics.DoesNotExist:
+        return None
+
+    if type(filt) == BaseFilter and attribute.type != 'boolean':
+        return statistics.get_servers_per_value()
+    return statistics.num_servers
+
+
+def _can_drive(attribute, filt):
+    if attribute.special or attribute.type == 'boolean':
+        return False
+    if not attribute.can_be_materialized():
+        return False
+    if isinstance(filt, All):
+        return False
+    if isinstance(filt, Any):
+        return bool(filt.values) and all(
+            type(v) == BaseFilter for v in filt.values
+        )
+    return not isinstance(filt, (Not, Empty))
 
 
-def _get_sql_condition(servertypes, attribute, filt):
+def _get_driving_template(attribute, filt, params):
+    if isinstance(filt, Any):
+        template = '{{0}} IN ({})'.format(
+            ', '.join(['%s'] * len(filt.values))
+        )
+        params.extend(_sql_param(v.value) for v in filt.values)
+        return _get_relation_template(attribute, template)
+
+    negate, template = _get_sql_template(attribute, filt, params)
+    assert not negate
+    return template
+
+
+def _get_order_by_sql(servertypes, order_by):   # NOQA: C901
+    """Return the joins and the expressions to order by the attributes
+
+    We want the servers which doesn't have the attribute at all to appear
+    at last, the servers which the attribute is not set to appear in
+    the beginning, and the rest in between.  This is the same order as
+    the materializer would sort the servers on Python.  The attributes
+    must be either special or single value ones stored on the servers
+    themselves.
+    """
+    joins = []
+    expressions = []
+    for index, attribute in enumerate(order_by):
+        if attribute.special:
+            field = attribute.special.field
+            if field.startswith('_'):
+                field = field[1:]
+            expressions.append('server.{} NULLS FIRST'.format(field))
+            continue
+
+        assert not attribute.multi and attribute.can_be_materialized()
+
+        attribute_servertypes = [
+            sa.servertype
+            for sa in ServertypeAttribute.query(servertypes, (attribute, ))
+        ]
+        if not attribute_servertypes:
+            continue
+
+        if len(attribute_servertypes) != len(servertypes):
+            expressions.append(
+                'CASE WHEN server.servertype_id IN ({}) THEN 0 ELSE 1 END'
+                .format(', '.join(
+                    "'{}'".format(s.pk) for s in attribute_servertypes
+                ))
+            )
+
+        alias = 'order_{}'.format(index)
+        table = ServerAttribute.get_model(attribute.type)._meta.db_table
+        joins.append(
+            ' LEFT JOIN {0} AS {1}'
+            ' ON {1}.server_id = server.server_id AND'
+            " {1}.attribute_id = '{2}'"
+            .format(table, alias, attribute.pk)
+        )
+
+        if attribute.type == 'boolean':
+            expressions.append('{}.server_id IS NOT NULL'.format(alias))
+        elif attribute.type == 'hostname':
+            joins.append(
+                ' LEFT JOIN server AS {0}_server'
+                ' ON {0}_server.server_id = {0}.value'
+                .format(alias)
+            )
+            expressions.append('{}_server.hostname NULLS FIRST'.format(alias))
+        else:
+            expressions.append('{}.value NULLS FIRST'.format(alias))
+
+    return joins, expressions
+
+
+def _get_sql_condition(servertypes, attribute, filt, params):
+    """Return the SQL condition and append its parameters to the list
+
+    The parameters must be appended in the same order as the placeholders
+    appear on the returned condition.
+    """
     assert isinstance(filt, BaseFilter)
 
     if isinstance(filt, (Not, Any)):
-        return _logical_filter_sql_condition(servertypes, attribute, filt)
+        return _logical_filter_sql_condition(
+            servertypes, attribute, filt, params
+        )
+
+    negate, template = _get_sql_template(attribute, filt, params)
+    return (
+        ('NOT ' if negate else '') +
+        _condition_sql(servertypes, attribute, template)
+    )
 
+
+def _get_sql_template(attribute, filt, params):
+    """Return whether to negate and the template for the value column"""
     negate = False
     template = ''
 
@@ -74,21 +353,27 @@ def _get_sql_condition(servertypes, attribute, filt):
         # TODO: Better return errors for mismatching datatypes than casting
         negate = not filt.value or filt.value == 'false'
     elif isinstance(filt, Regexp):
-        template = '{0}::text ~ E' + _raw_sql_escape(filt.value)
+        template = '{0}::text ~ %s'
+        params.append(_sql_param(filt.value))
     elif isinstance(filt, (
         Comparison,
         GreaterThanOrEquals,
         LessThanOrEquals,
     )):
-        template = _basic_comparison_filter_template(attribute, filt)
+        template = _basic_comparison_filter_template(attribute, filt, params)
     elif isinstance(filt, Overlaps):
-        template = _containment_filter_template(attribute, filt)
+        template = _containment_filter_template(attribute, filt, params)
     elif isinstance(filt, Empty):
         negate = True
         template = '{0} IS NOT NULL'
     else:
-        template = '{0} = ' + _raw_sql_escape(filt.value)
+        template = '{0} = %s'
+        params.append(_sql_param(filt.value))
+
+    return negate, _get_relation_template(attribute, template)
+
 
+def _get_relation_template(attribute, template):
     if attribute.type in ('hostname', 'reverse_hostname', 'supernet'):
         template = (
             '{{0}} IN ('
@@ -99,16 +384,13 @@ def _get_sql_condition(servertypes, attribute, filt):
             .format(template.format('hostname'))
         )
 
-    return (
-        ('NOT ' if negate else '') +
-        _condition_sql(servertypes, attribute, template)
-    )
+    return template
 
 
-def _logical_filter_sql_condition(servertypes, attribute, filt):
+def _logical_filter_sql_condition(servertypes, attribute, filt, params):
     if isinstance(filt, Not):
         return 'NOT ({0})'.format(_get_sql_condition(
-            servertypes, attribute, filt.value
+            servertypes, attribute, filt.value, params
         ))
 
     if isinstance(filt, All):
@@ -125,25 +407,30 @@ def _logical_filter_sql_condition(servertypes, attribute, filt):
         if type(filt) == Any and type(value) == BaseFilter:
             simple_values.append(value)
         else:
-            templates.append(_get_sql_condition(servertypes, attribute, value))
+            templates.append(_get_sql_condition(
+                servertypes, attribute, value, params
+            ))
 
+    # The condition for the simple values goes to the end, so their
+    # parameters have to be appended after all of the others.
     if simple_values:
         if len(simple_values) == 1:
             template = _get_sql_condition(
-                servertypes, attribute, simple_values[0]
+                servertypes, attribute, simple_values[0], params
             )
         else:
             template = _condition_sql(
-                servertypes, attribute, '{{0}} IN ({0})'.format(', '.join(
-                    _raw_sql_escape(v.value) for v in simple_values
-                ))
+                servertypes, attribute, '{{0}} IN ({0})'.format(
+                    ', '.join(['%s'] * len(simple_values))
+                )
             )
+            params.extend(_sql_param(v.value) for v in simple_values)
         templates.append(template)
 
     return '({0})'.format(joiner.join(templates))
 
 
-def _basic_comparison_filter_template(attribute, filt):
+def _basic_comparison_filter_template(attribute, filt, params):
     if isinstance(filt, Comparison):
         operator = filt.comparator
     elif isinstance(filt, GreaterThan):
@@ -155,42 +442,45 @@ def _basic_comparison_filter_template(attribute, filt):
     else:
         operator = '<='
 
-    return '{{}} {} {}'.format(
-        operator, _raw_sql_escape(filt.value)
-    )
+    params.append(_sql_param(filt.value))
 
+    return '{{}} {} %s'.format(operator)
 
-def _containment_filter_template(attribute, filt):
-    template = None     # To be formatted 2 times
+
+def _containment_filter_template(attribute, filt, params):
+    template = None     # To be formatted with the column
     value = filt.value
+    num_params = 1
 
     if attribute.type == 'inet':
         if isinstance(filt, StartsWith):
-            template = "{{0}} >>= {0} AND host({{0}}) = host(0{})"
+            template = '{0} >>= %s AND host({0}) = host(%s)'
+            num_params = 2
         elif isinstance(filt, Contains):
-            template = "{{0}} >>= {0}"
+            template = '{0} >>= %s'
         elif isinstance(filt, ContainedOnlyBy):
             template = (
-                "{{0}} << {0} AND NOT EXISTS ("
+                '{0} << %s AND NOT EXISTS ('
                 '   SELECT 1 '
                 '   FROM server AS supernet '
-                '   WHERE {{0}} << supernet.intern_ip AND '
-                '       supernet.intern_ip << {0}'
+                '   WHERE {0} << supernet.intern_ip AND '
+                '       supernet.intern_ip << %s'
                 ')'
             )
+            num_params = 2
         elif isinstance(filt, ContainedBy):
-            template = "{{0}} <<= {0}"
+            template = '{0} <<= %s'
         else:
-            template = "{{0}} && {0}"
+            template = '{0} && %s'
 
     elif attribute.type == 'string':
         if isinstance(filt, Contains):
-            template = "{{0}} LIKE {0}"
+            template = '{0} LIKE %s'
             value = '{}{}{}'.format(
                 '' if isinstance(filt, StartsWith) else '%', value, '%'
             )
         elif isinstance(filt, ContainedBy):
-            template = "{0} LIKE '%%' || {{0}} || '%%'"
+            template = "%s LIKE '%%' || {0} || '%%'"
 
     if not template:
         raise FilterValueError(
@@ -198,7 +488,9 @@ def _containment_filter_template(attribute, filt):
             .format(type(filt).__name__, attribute)
         )
 
-    return template.format(_raw_sql_escape(value))
+    params.extend([_sql_param(value)] * num_params)
+
+    return template
 
 
 def _condition_sql(servertypes, attribute, template):   # NOQA: C901
@@ -238,9 +530,7 @@ def _condition_sql(servertypes, attribute, template):   # NOQA: C901
     relation_conditions = []
     related_via_attributes = set()
     other_servertypes = list()
-    for sa in attribute.servertype_attributes.filter(
-        _servertype__in=servertypes
-    ):
+    for sa in ServertypeAttribute.query(servertypes, (attribute, )):
         if sa.related_via_attribute:
             related_via_attributes.add(sa.related_via_attribute)
         else:
@@ -248,8 +538,8 @@ def _condition_sql(servertypes, attribute, template):   # NOQA: C901
     for related_via_attribute in related_via_attributes:
         related_via_servertypes = tuple(
             sa.servertype
-            for sa in related_via_attribute.servertype_attributes.filter(
-                _servertype__in=servertypes
+            for sa in ServertypeAttribute.query(
+                servertypes, (related_via_attribute, )
             )
         )
         assert related_via_servertypes
@@ -312,20 +602,8 @@ def _exists_sql(table, alias, conditions):
     )
 
 
-def _raw_sql_escape(value):
+def _sql_param(value):
     try:
-        value = str(value)
+        return str(value)
     except UnicodeEncodeError as error:
         raise FilterValueError(str(error))
-
-    if "'" in value:
-        raise FilterValueError('Single quote cannot be used')
-
-    if value.endswith('\\'):
-        raise FilterValueError(
-            'Escape character cannot be used in the end'
-        )
-
-    value = value.replace('{', '{{').replace('}', '}}').replace('%', '%%')
-
-    return "'" + value + "'"
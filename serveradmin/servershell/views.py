@@ -28,6 +28,7 @@ from serveradmin.serverdb.models import (
     Attribute,
     ServertypeAttribute,
     ServerStringAttribute,
+    servertype_attribute_index,
 )
 from serveradmin.serverdb.query_committer import (
     QueryCommitter,
@@ -102,8 +103,11 @@ def get_results(request):
         order_by = None
 
     try:
-        query = Query(parse_query(term), shown_attributes, order_by)
-        num_servers = len(query)
+        query = Query(
+            parse_query(term), shown_attributes, order_by, limit, offset
+        )
+        num_servers = query.count()
+        servers = list(query)
     except (
         DatatypeError, ObjectDoesNotExist, ValidationError, DataError
     ) as error:
@@ -112,8 +116,6 @@ def get_results(request):
             'message': str(error)
         }))
 
-    servers = list(islice(query, offset, offset + limit))
-
     request.session['term'] = term
     request.session['per_page'] = limit
 
@@ -136,7 +138,7 @@ def get_results(request):
     avail_attributes = dict()
     for servertype in servertypes:
         avail_attributes[servertype.pk] = dict(specials)
-    for sa in ServertypeAttribute.query(servertypes, attributes).all():
+    for sa in ServertypeAttribute.query(servertypes, attributes):
         if not sa.related_via_attribute:
             avail_attributes[sa.servertype.pk][sa.attribute.pk] = {
                 'regexp': sa.regexp,
@@ -235,11 +237,9 @@ def _edit(request, server, edit_mode=False, template='edit'):   # NOQA: C901
         if invalid_attrs:
             messages.error(request, 'Attributes contain invalid values')
 
-    servertype_attributes = {
-        sa.attribute.pk: sa
-        for sa
-        in Servertype.objects.get(pk=server['servertype']).attributes.all()
-    }
+    servertype_attributes = servertype_attribute_index.by_servertype(
+        Servertype.objects.get(pk=server['servertype'])
+    )
 
     fields = []
     fields_set = set()
@@ -209,6 +209,11 @@ LOGGING = {
 
 OBJECTS_PER_PAGE = 25
 
+# The results of the dataset queries are cached in the memory of
+# the processes.  They can also be shared between them through one of
+# the CACHES of Django by setting the alias of it.
+QUERY_CACHE = None
+
 # Graphite URL is required to generate graphic URL's.  Normal graphs are
 # requested from Graphite on the browser. Small graphs on the overview page are
 # requested and stored by the Serveradmin from the Graphite. Graphs are stored
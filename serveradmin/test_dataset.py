@@ -1,14 +1,53 @@
-from ipaddress import IPv4Address
+import asyncio
+from collections import OrderedDict
+from datetime import date
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from io import StringIO
+from ipaddress import IPv4Address, ip_network
+import json
+import os
+import socket
+import sys
+from socketserver import ThreadingMixIn
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import sleep, time
+from unittest import mock, skipIf
+from urllib.parse import urlencode
 from django.contrib.auth.models import User
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import DataError, connection
+from django.test import SimpleTestCase, TestCase
 
+from adminapi import dataset, request, schema
+from adminapi.datatype import DatatypeError
 from adminapi.filters import (
     Any,
+    BaseFilter,
     Not,
     Regexp,
     StartsWith,
 )
+from serveradmin.api import views
+from serveradmin.apps.models import Application
 from serveradmin.dataset import Query
+from serveradmin.serverdb.models import (
+    Attribute,
+    AttributeStatistics,
+    Server,
+    Servertype,
+    ServertypeAttribute,
+    lookup_version,
+    network_index,
+    servertype_attribute_index,
+)
+from serveradmin.serverdb.query_cache import (
+    ANY,
+    CachedQuery,
+    increment_data_versions,
+)
+from serveradmin.serverdb.query_watcher import QueryWatcher
+from serveradmin.serverdb.radix_tree import RadixTree
 
 
 class TestQuery(TestCase):
@@ -41,6 +80,14 @@ class TestQuery(TestCase):
         self.assertNotIn('test1', hostnames)
         self.assertIn('test2', hostnames)
 
+    def test_filter_regexp_escape(self):
+        q = Query({'hostname': Regexp(r'^test\d$')})
+        self.assertEqual(len(q), 4)
+
+    def test_filter_quote(self):
+        q = Query({'os': "wheezy'"})
+        self.assertEqual(len(q), 0)
+
     def test_filter_regexp_servertype(self):
         s = Query({'servertype': Regexp('^test[870]')}).get()
         self.assertEqual(s['hostname'], 'test0')
@@ -71,6 +118,66 @@ class TestQuery(TestCase):
         q = Query({'servertype': StartsWith('tes')})
         self.assertEqual(len(q), 4)
 
+    def test_count(self):
+        q = Query({'servertype': 'test2'}, limit=1)
+        self.assertEqual(q.count(), 3)
+        self.assertEqual(len(q), 1)
+
+    def test_explain(self):
+        result = Query({'servertype': 'test2'}, ['hostname']).explain()
+        self.assertEqual(result['possible_servertypes'], ['test2'])
+        self.assertEqual(result['num_servers'], 3)
+        self.assertIn('SELECT', result['sql'])
+        self.assertTrue(result['plan'])
+        self.assertEqual(
+            list(result['timings']),
+            [
+                'filtering',
+                'materialization',
+                'materialization_phases',
+                'serialization',
+            ],
+        )
+
+    def test_explain_impossible(self):
+        result = Query({'servertype': 'nonexistent'}).explain()
+        self.assertIsNone(result['sql'])
+        self.assertEqual(result['num_servers'], 0)
+
+    def test_count_new_objects(self):
+        q = Query(limit=1)
+        q.new_object('test0')
+        q.new_object('test0')
+        self.assertEqual(q.count(), 2)
+
+    def test_limit_offset(self):
+        q = Query({}, ['hostname'], limit=2, offset=1)
+        self.assertEqual([s['hostname'] for s in q], ['test1', 'test2'])
+
+    def test_order_by(self):
+        q = Query({}, ['hostname'], ['game_world'])
+        hostnames = [s['hostname'] for s in q]
+        self.assertEqual(hostnames, ['test1', 'test2', 'test3', 'test0'])
+
+    def test_order_by_limit(self):
+        q = Query({'servertype': 'test2'}, ['hostname'], ['game_world'], 2)
+        self.assertEqual([s['hostname'] for s in q], ['test1', 'test2'])
+
+    def test_query_statistics(self):
+        call_command('update_attribute_statistics', stdout=StringIO())
+        s = Query({'hostname': Regexp('^test'), 'os': 'wheezy'}).get()
+        self.assertEqual(s['hostname'], 'test0')
+
+    def test_statistics_lookup_version(self):
+        version = lookup_version.get()
+        call_command('update_attribute_statistics', stdout=StringIO())
+        lookup_version.expire()
+        self.assertEqual(lookup_version.get(), version)
+
+        statistics = AttributeStatistics.objects.get(pk='os')
+        self.assertEqual(statistics.num_servers, 4)
+        self.assertEqual(statistics.num_distinct_values, 2)
+
 
 class TestCommit(TestCase):
     fixtures = ['test_dataset.json']
@@ -103,3 +210,1037 @@ class TestCommit(TestCase):
 
     def test_commit_newer_data(self):
         pass
+
+
+class TestQueryCache(TestCase):
+    fixtures = ['test_dataset.json']
+    filters = {'hostname': BaseFilter('test0')}
+    join_restrict = ['hostname', {'os': ['hostname']}]
+
+    def _commit(self, hostname, os):
+        q = Query({'hostname': hostname})
+        q.get()['os'] = os
+        q.commit(user=User.objects.first())
+
+    def test_cache_get(self):
+        CachedQuery(self.filters, None, None).set(['{"object_id": 1}'])
+        cached_query = CachedQuery(self.filters, None, None)
+        self.assertEqual(cached_query.get(), ['{"object_id": 1}'])
+
+        self._commit('test1', 'wheezy')
+        self.assertEqual(
+            CachedQuery(self.filters, None, None).get_etag('json'),
+            cached_query.get_etag('json'),
+        )
+        self._commit('test0', 'squeeze')
+        self.assertIsNone(CachedQuery(self.filters, None, None).get())
+
+    def test_join_versions(self):
+        etag = CachedQuery(self.filters, self.join_restrict, None).get_etag(
+            'json'
+        )
+        self._commit('test1', 'wheezy')
+        self.assertNotEqual(
+            CachedQuery(self.filters, self.join_restrict, None).get_etag(
+                'json'
+            ),
+            etag,
+        )
+
+
+class TestClientQuery(SimpleTestCase):
+    servers = [
+        {'object_id': 1, 'hostname': 'test0', 'os': 'wheezy'},
+        {'object_id': 2, 'hostname': 'test1', 'os': 'squeeze'},
+    ]
+
+    def setUp(self):
+        for name, side_effect in (
+            ('stream_request', self._stream_request),
+            ('send_request', self._send_request),
+            ('get_schema', schema.Schema),
+        ):
+            patcher = mock.patch.object(
+                dataset, name, side_effect=side_effect
+            )
+            setattr(self, name, patcher.start())
+            self.addCleanup(patcher.stop)
+
+    def _stream_request(self, endpoint, get_params=None, post_params=None,
+                        cache_ttl=None):
+        for server in self.servers:
+            yield dict(server)
+        yield {'status': 'success'}
+
+    def _send_request(self, endpoint, get_params=None, post_params=None):
+        return {'status': 'success'}
+
+    def test_commit_after_partial_iteration(self):
+        q = dataset.Query({'hostname': Regexp('^test')})
+        for s in q:
+            s['os'] = 'stretch'
+            break
+        q.commit()
+
+        self.assertEqual(self.stream_request.call_count, 1)
+        commit = self.send_request.call_args[1]['post_params']
+        self.assertEqual(commit['changed'], [{
+            'object_id': 1,
+            'os': {'action': 'update', 'old': 'wheezy', 'new': 'stretch'},
+        }])
+
+    def test_access_during_iteration(self):
+        q = dataset.Query({'hostname': Regexp('^test')})
+        for s in q:
+            self.assertEqual(len(q), 2)
+            self.assertIs(q.get_lookup('hostname')[s['hostname']], s)
+        self.assertEqual([s['hostname'] for s in q], ['test0', 'test1'])
+        self.assertEqual(self.stream_request.call_count, 1)
+
+    def test_columns(self):
+        documents = [
+            {
+                'columns': ['object_id', 'hostname', 'intern_ip', 'database'],
+                'types': ['number', 'string', 'inet', 'string'],
+            },
+            [0, 1, 'test0', '10.16.2.1', ['db0']],
+            {'status': 'success'},
+        ]
+        self.stream_request.side_effect = lambda *args, **kwargs: (
+            iter(documents)
+        )
+        server = dataset.Query({'hostname': 'test0'}, columns=True).get()
+        post_params = self.stream_request.call_args[1]['post_params']
+        self.assertEqual(post_params['format'], 'columns')
+        self.assertEqual(server['intern_ip'], IPv4Address('10.16.2.1'))
+        self.assertIsInstance(server['database'], dataset.MultiAttr)
+        self.assertEqual(server['database'], {'db0'})
+
+        server = dataset.Query(
+            {'hostname': 'test0'}, columns=True, read_only=True
+        ).get()
+        self.assertIsInstance(server, dataset.FrozenObject)
+        self.assertEqual(server['database'], frozenset(['db0']))
+
+    def test_columns_not_requested(self):
+        list(dataset.Query({'hostname': Regexp('^test')}))
+        post_params = self.stream_request.call_args[1]['post_params']
+        self.assertNotIn('format', post_params)
+
+    def test_old_response(self):
+        self.stream_request.side_effect = lambda *args, **kwargs: iter([
+            {'status': 'success', 'result': [dict(s) for s in self.servers]},
+        ])
+        q = dataset.Query({'hostname': Regexp('^test')})
+        self.assertEqual([s['hostname'] for s in q], ['test0', 'test1'])
+
+    def test_incomplete_response(self):
+        self.stream_request.side_effect = lambda *args, **kwargs: (
+            dict(s) for s in self.servers
+        )
+        with self.assertRaises(dataset.DatasetError):
+            list(dataset.Query({'hostname': Regexp('^test')}))
+
+    def test_explain(self):
+        self.send_request.side_effect = lambda *args, **kwargs: {
+            'status': 'success', 'result': {'sql': 'SELECT'},
+        }
+        q = dataset.Query({'hostname': 'test0'}, ['hostname'])
+        self.assertEqual(q.explain(), {'sql': 'SELECT'})
+        self.assertEqual(
+            self.send_request.call_args[0][0], dataset.EXPLAIN_ENDPOINT
+        )
+        self.assertEqual(
+            self.send_request.call_args[1]['post_params']['restrict'],
+            ['hostname'],
+        )
+
+    def test_sync(self):
+        status = {
+            'status': 'success',
+            'commit_id': 1,
+            'last_commit_id': 1,
+            'deleted': [],
+        }
+        self.stream_request.side_effect = lambda *args, **kwargs: iter(
+            [dict(s) for s in self.servers] + [status]
+        )
+        q = dataset.Query({'hostname': Regexp('^test')})
+        changes = q.sync()
+        self.assertEqual(len(changes.created), 2)
+        self.assertEqual([s['hostname'] for s in q], ['test0', 'test1'])
+
+        # The results are not fetched before the first synchronization.
+        self.assertEqual(self.stream_request.call_count, 1)
+        self.assertEqual(
+            self.stream_request.call_args[0][0], dataset.CHANGES_ENDPOINT
+        )
+
+    def test_watch(self):
+        status = {
+            'status': 'success',
+            'commit_id': 1,
+            'last_commit_id': 2,
+            'deleted': [],
+        }
+        changed = dict(self.servers[1], os='stretch')
+        responses = [
+            [dict(s) for s in self.servers] + [status],
+            [dict(status, commit_id=2, last_commit_id=3)],
+            [changed, dict(status, commit_id=3, last_commit_id=3)],
+        ]
+        self.stream_request.side_effect = lambda *args, **kwargs: iter(
+            responses.pop(0)
+        )
+        q = dataset.Query({'hostname': Regexp('^test')})
+        changes = next(q.watch(timeout=10))
+        self.assertEqual([s['hostname'] for s in changes.changed], ['test1'])
+        self.assertEqual(q.get_lookup('hostname')['test1']['os'], 'stretch')
+
+        calls = self.stream_request.call_args_list
+        self.assertEqual(
+            [c[0][0] for c in calls],
+            [
+                dataset.CHANGES_ENDPOINT,
+                dataset.WATCH_ENDPOINT,
+                dataset.WATCH_ENDPOINT,
+            ],
+        )
+        self.assertEqual(
+            calls[2][0][1], [('since', 2), ('seen', 3), ('timeout', 10)]
+        )
+
+    def test_pages(self):
+        self.send_request.side_effect = [
+            {'status': 'success', 'result': [dict(s)], 'cursor': c}
+            for s, c in zip(self.servers, ['a', None])
+        ]
+        q = dataset.Query({'hostname': Regexp('^test')}, page_size=1)
+        self.assertEqual([s['hostname'] for s in q], ['test0', 'test1'])
+        requests = [
+            c[1]['post_params'] for c in self.send_request.call_args_list
+        ]
+        self.assertEqual([r['page_size'] for r in requests], [1, 1])
+        self.assertEqual(requests[1]['cursor'], 'a')
+
+    def _send_multi_query(self, endpoint, get_params=None, post_params=None):
+        self.assertEqual(endpoint, dataset.MULTI_QUERY_ENDPOINT)
+        return {'status': 'success', 'results': [
+            {'status': 'success', 'result': [dict(self.servers[0])]},
+            {'status': 'error', 'type': 'ValueError', 'message': 'Invalid'},
+        ]}
+
+    def test_read_only(self):
+        self.stream_request.side_effect = lambda *args, **kwargs: iter([
+            dict(s, database=['db0']) for s in self.servers
+        ] + [{'status': 'success'}])
+        q = dataset.Query({'hostname': Regexp('^test')}, read_only=True)
+        s0, s1 = q
+        self.assertIsInstance(s0, dataset.FrozenObject)
+        self.assertEqual(s0, {
+            'object_id': 1,
+            'hostname': 'test0',
+            'os': 'wheezy',
+            'database': frozenset(['db0']),
+        })
+        self.assertIs(s0._positions, s1._positions)
+        self.assertEqual(len({s0, s1}), 2)
+        self.assertFalse(q.is_dirty())
+        with self.assertRaises(TypeError):
+            s0['os'] = 'stretch'
+        with self.assertRaises(dataset.DatasetError):
+            q.commit()
+        with self.assertRaises(dataset.DatasetError):
+            q.new_object('test0')
+
+    def test_positions_limit(self):
+        with mock.patch.multiple(
+            dataset, MAX_POSITIONS=2, _positions=OrderedDict()
+        ):
+            positions = dataset._get_positions(['object_id', 'a'])
+            dataset._get_positions(['object_id', 'b'])
+            self.assertIs(
+                dataset._get_positions(['object_id', 'a']), positions
+            )
+            dataset._get_positions(['object_id', 'c'])
+            self.assertEqual(
+                list(dataset._positions),
+                [('object_id', 'a'), ('object_id', 'c')],
+            )
+
+    def test_batch(self):
+        self.send_request.side_effect = self._send_multi_query
+        with dataset.QueryBatch():
+            q1 = dataset.Query({'hostname': 'test0'}, read_only=True)
+            q2 = dataset.Query({'hostname': Regexp('^test')})
+            q3 = dataset.Query({'hostname': 'test0'}, cache_ttl=60)
+        self.assertEqual(q1.get()['hostname'], 'test0')
+        self.assertIsInstance(q1.get(), dataset.FrozenObject)
+        self.assertEqual(self.send_request.call_count, 1)
+        queries = self.send_request.call_args[1]['post_params']['queries']
+        self.assertEqual(len(queries), 2)
+
+        # The failed and the not batched queries are fetched alone.
+        self.assertEqual(len(q2), 2)
+        self.assertEqual(len(q3), 2)
+        self.assertEqual(self.stream_request.call_count, 2)
+
+    def test_batch_unsupported(self):
+        self.send_request.side_effect = request.HTTPError(
+            dataset.MULTI_QUERY_ENDPOINT, 404, 'Not Found', {}, None
+        )
+        with dataset.QueryBatch():
+            q1 = dataset.Query({'hostname': Regexp('^test')})
+            q2 = dataset.Query({'hostname': Regexp('^test')})
+        self.assertEqual(len(q1), 2)
+        self.assertEqual(len(q2), 2)
+        self.assertEqual(self.send_request.call_count, 1)
+        self.assertEqual(self.stream_request.call_count, 2)
+
+
+class TestMultiAttr(SimpleTestCase):
+    def setUp(self):
+        self.obj = dataset._format_obj({
+            'object_id': 1,
+            'hostname': 'test0',
+            'database': ['db0', 'db1'],
+        })
+        self.databases = self.obj['database']
+
+    def test_add(self):
+        self.databases.add('db2')
+        self.assertIs(self.obj['database'], self.databases)
+        self.assertEqual(self.obj._serialize_changes(), {
+            'object_id': 1,
+            'database': {'action': 'multi', 'remove': set(), 'add': {'db2'}},
+        })
+
+    def test_unchanged(self):
+        self.databases.add('db0')
+        self.databases.discard('db2')
+        self.assertFalse(self.obj.old_values)
+
+        self.databases.remove('db0')
+        self.databases.add('db0')
+        self.assertFalse(self.obj.is_dirty())
+        self.assertEqual(self.obj._serialize_changes(), {'object_id': 1})
+
+    def test_updates(self):
+        self.databases.update(['db1', 'db2'])
+        self.databases.difference_update(['db0'])
+        self.databases.symmetric_difference_update(['db2', 'db3'])
+        self.databases.intersection_update(['db1', 'db2', 'db3'])
+        self.assertEqual(self.databases, {'db1', 'db3'})
+        self.assertEqual(self.obj.old_values['database'], {'db0', 'db1'})
+
+    def test_rollback(self):
+        self.databases.clear()
+        self.obj.rollback()
+        self.assertEqual(self.obj['database'], {'db0', 'db1'})
+        self.assertFalse(self.obj.is_dirty())
+
+    def test_validation(self):
+        with self.assertRaises(DatatypeError):
+            self.databases.add(1)
+        with self.assertRaises(DatatypeError):
+            self.databases.update(['db2', 1])
+        self.assertEqual(self.databases, {'db0', 'db1'})
+        self.assertFalse(self.obj.old_values)
+
+    def test_deleted(self):
+        self.obj.delete()
+        with self.assertRaises(dataset.DatasetError):
+            self.databases.add('db2')
+
+
+class TestRadixTree(SimpleTestCase):
+    def setUp(self):
+        self.tree = RadixTree()
+        for network in ('10.0.0.0/8', '10.16.0.0/16', '10.16.2.0/24', '::/0'):
+            self.tree.insert(ip_network(network), network)
+
+    def test_longest_match(self):
+        get = self.tree.get_longest_match
+        self.assertEqual(get(ip_network('10.16.2.1/32')), '10.16.2.0/24')
+        self.assertEqual(get(ip_network('10.16.3.0/24')), '10.16.0.0/16')
+        self.assertEqual(get(ip_network('10.16.0.0/16')), '10.16.0.0/16')
+        self.assertEqual(get(ip_network('11.0.0.0/8')), None)
+        self.assertEqual(get(ip_network('2001:db8::/32')), '::/0')
+
+    def test_iter_matches(self):
+        matches = self.tree.iter_matches(ip_network('10.16.2.128/25'))
+        self.assertEqual(
+            [v for n, v in matches],
+            ['10.0.0.0/8', '10.16.0.0/16', '10.16.2.0/24'],
+        )
+
+
+class TestNetworkIndex(TestCase):
+    fixtures = ['test_dataset.json']
+
+    def setUp(self):
+        Servertype.objects.create(
+            servertype_id='network', description='', ip_addr_type='network'
+        )
+        self.servertype = Servertype.objects.get(pk='network')
+        self._add_network('net0', '10.16.0.0/16')
+
+    def _add_network(self, hostname, intern_ip):
+        Server.objects.create(
+            hostname=hostname,
+            intern_ip=intern_ip,
+            _servertype_id='network',
+            _project_id='someproject',
+        )
+        # The QueryCommitter would increment the version of the servertype.
+        increment_data_versions([('network', ANY)])
+        network_index.expire()
+
+    def _get_supernet(self, intern_ip):
+        return network_index.get_supernet(
+            self.servertype, IPv4Address(intern_ip)
+        )
+
+    def test_get_supernet(self):
+        self.assertEqual(self._get_supernet('10.16.2.1').hostname, 'net0')
+        self.assertIsNone(self._get_supernet('10.17.0.1'))
+
+    def test_changed_networks(self):
+        self.assertEqual(self._get_supernet('10.16.2.1').hostname, 'net0')
+        self._add_network('net1', '10.16.2.0/24')
+        self.assertEqual(self._get_supernet('10.16.2.1').hostname, 'net1')
+        self.assertEqual(self._get_supernet('10.16.3.1').hostname, 'net0')
+
+    def test_supernet_copies(self):
+        self._get_supernet('10.16.2.1').hostname = 'changed'
+        self.assertEqual(self._get_supernet('10.16.2.1').hostname, 'net0')
+
+
+class TestServertypeAttributeIndex(TestCase):
+    fixtures = ['test_dataset.json']
+
+    def test_query(self):
+        test0 = Servertype.objects.get(pk='test0')
+        test2 = Servertype.objects.get(pk='test2')
+        os = Attribute.objects.get(pk='os')
+        self.assertEqual(
+            sorted(sa.servertype.pk for sa in ServertypeAttribute.query(
+                attributes=[os]
+            )),
+            ['test0', 'test2'],
+        )
+        self.assertEqual(
+            [sa.attribute.pk for sa in ServertypeAttribute.query(
+                [test0], [os]
+            )],
+            ['os'],
+        )
+        self.assertEqual(
+            list(servertype_attribute_index.by_servertype(test2)),
+            ['os', 'game_world'],
+        )
+
+    def test_get(self):
+        test0 = Servertype.objects.get(pk='test0')
+        game_world = Attribute.objects.get(pk='game_world')
+        with self.assertRaises(ServertypeAttribute.DoesNotExist):
+            servertype_attribute_index.get(test0, game_world)
+
+        ServertypeAttribute.objects.create(
+            _servertype=test0, _attribute=game_world
+        )
+        self.assertEqual(
+            servertype_attribute_index.get(test0, game_world).attribute,
+            game_world,
+        )
+
+
+class TestQueryWatcher(TestCase):
+    fixtures = ['test_dataset.json']
+
+    def test_received_notifies(self):
+        watcher = QueryWatcher({'servertype': BaseFilter('test2')}, None)
+        pg_connection = mock.Mock(notifies=[
+            mock.Mock(payload=json.dumps({'keys': [['test0', 'os']]})),
+            mock.Mock(payload=json.dumps({'keys': [['test2', 'os']]})),
+        ])
+        with mock.patch.object(connection, 'connection', pg_connection):
+            # The buffered notifications are checked without waiting.
+            self.assertTrue(watcher.wait(60))
+        self.assertFalse(pg_connection.notifies)
+
+
+class TestAPI(TestCase):
+    fixtures = ['test_dataset.json']
+
+    def setUp(self):
+        self.app = Application.objects.create(
+            name='test', owner=User.objects.first(), location='test'
+        )
+
+    def _request(self, endpoint, data=None, get_params=None, **headers):
+        body = '' if data is None else json.dumps(data)
+        timestamp = int(time())
+        url = '/api' + endpoint
+        if get_params:
+            url += '?' + urlencode(get_params)
+        return self.client.post(
+            url,
+            body,
+            content_type='application/x-json',
+            HTTP_X_APPLICATION=self.app.app_id,
+            HTTP_X_TIMESTAMP=str(timestamp),
+            HTTP_X_SECURITYTOKEN=request.calc_security_token(
+                self.app.auth_token, timestamp, body or None
+            ),
+            **headers
+        )
+
+    def _get_documents(self, response):
+        if response.streaming:
+            content = b''.join(response.streaming_content)
+        else:
+            content = response.content
+        return [json.loads(l) for l in content.decode().splitlines()]
+
+    def test_query_not_modified(self):
+        data = {'filters': {'servertype': 'test2'}}
+        response = self._request('/dataset/query', data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self._get_documents(response)[0]['result']), 3)
+
+        etag = response['ETag']
+        response = self._request(
+            '/dataset/query', data, HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        q = Query({'hostname': 'test1'})
+        q.get()['os'] = 'wheezy'
+        q.commit(user=User.objects.first())
+        response = self._request(
+            '/dataset/query', data, HTTP_IF_NONE_MATCH=etag
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_schema(self):
+        response = self._request('/dataset/schema')
+        attributes = self._get_documents(response)[0]['attributes']
+        self.assertEqual(attributes['os'], {'type': 'string', 'multi': False})
+        self.assertTrue(attributes['database']['multi'])
+
+        response = self._request(
+            '/dataset/schema', HTTP_IF_NONE_MATCH=response['ETag']
+        )
+        self.assertEqual(response.status_code, 304)
+
+    def test_changes(self):
+        data = {'filters': {'servertype': 'test2'}, 'restrict': ['hostname']}
+        documents = self._get_documents(
+            self._request('/dataset/changes', data)
+        )
+        self.assertEqual(
+            sorted(d['hostname'] for d in documents[:-1]),
+            ['test1', 'test2', 'test3'],
+        )
+        status = documents[-1]
+        self.assertEqual(status['status'], 'success')
+        self.assertEqual(status['deleted'], [])
+
+        q = Query({'hostname': Any('test0', 'test1')})
+        for s in q:
+            s['os'] = 'squeeze' if s['hostname'] == 'test0' else 'wheezy'
+        q.commit(user=User.objects.first())
+
+        documents = self._get_documents(self._request(
+            '/dataset/changes', data, {'since': status['commit_id']}
+        ))
+        self.assertEqual([d['hostname'] for d in documents[:-1]], ['test1'])
+        # The changed servers not matching the filters are deleted.
+        self.assertEqual(documents[-1]['deleted'], [1])
+        self.assertGreater(
+            documents[-1]['last_commit_id'], status['last_commit_id']
+        )
+
+    def test_explain(self):
+        response = self._request(
+            '/dataset/explain', {'filters': {'hostname': 'test0'}}
+        )
+        result = self._get_documents(response)[0]['result']
+        self.assertEqual(result['num_servers'], 1)
+
+        response = self._request(
+            '/dataset/explain', {'filters': {'hostname': {'Regexp': '('}}}
+        )
+        self.assertEqual(self._get_documents(response)[0]['status'], 'error')
+
+    def test_query_stream(self):
+        data = {'filters': {'servertype': 'test2'}, 'stream': True}
+        response = self._request('/dataset/query', data)
+        self.assertTrue(response.streaming)
+        self.assertEqual(
+            response['Content-Type'], request.STREAM_CONTENT_TYPE
+        )
+        documents = self._get_documents(response)
+        self.assertEqual(
+            sorted(d['hostname'] for d in documents[:-1]),
+            ['test1', 'test2', 'test3'],
+        )
+        self.assertEqual(documents[-1]['status'], 'success')
+
+    def test_stream_error(self):
+        def chunks():
+            yield [{'object_id': 1}]
+            raise DataError('invalid input')
+
+        documents = list(views._stream_chunks(chunks()))
+        self.assertEqual(len(documents), 2)
+        self.assertEqual(documents[-1]['status'], 'error')
+        self.assertEqual(documents[-1]['type'], 'DataError')
+
+    def test_query_pages(self):
+        data = {'filters': {'servertype': 'test2'}, 'page_size': 2}
+        pages = []
+        while True:
+            response = self._get_documents(
+                self._request('/dataset/query', data)
+            )[0]
+            pages.append([s['hostname'] for s in response['result']])
+            if not response['cursor']:
+                break
+            data['cursor'] = response['cursor']
+        self.assertEqual(pages, [['test1', 'test2'], ['test3']])
+
+    def test_query_pages_ordered(self):
+        data = {
+            'filters': {'servertype': 'test2'},
+            'order_by': ['hostname'],
+            'page_size': 2,
+        }
+        response = self._get_documents(self._request('/dataset/query', data))
+        self.assertEqual(response[0]['status'], 'error')
+
+    def test_query_columns(self):
+        data = {
+            'filters': {'servertype': 'test2'},
+            'restrict': ['hostname', 'game_world'],
+            'stream': True,
+            'format': 'columns',
+        }
+        documents = self._get_documents(self._request('/dataset/query', data))
+        columns = documents[0]['columns']
+        types = dict(zip(columns, documents[0]['types']))
+        self.assertEqual(types['game_world'], 'number')
+        rows = documents[1:-1]
+        self.assertEqual({r[0] for r in rows}, {0})
+        self.assertEqual(
+            sorted(r[1 + columns.index('hostname')] for r in rows),
+            ['test1', 'test2', 'test3'],
+        )
+        self.assertEqual(documents[-1]['status'], 'success')
+
+    def _watch(self, since, seen, timeout):
+        return self._get_documents(self._request(
+            '/dataset/watch',
+            {'filters': {'servertype': 'test2'}, 'restrict': ['hostname']},
+            {'since': since, 'seen': seen, 'timeout': timeout},
+        ))
+
+    def test_watch_timeout(self):
+        status = self._get_documents(self._request(
+            '/dataset/changes', {'filters': {'servertype': 'test2'}}
+        ))[-1]
+        documents = self._watch(
+            status['commit_id'], status['last_commit_id'], 0
+        )
+        self.assertEqual(len(documents), 1)
+        self.assertEqual(documents[0]['status'], 'success')
+
+    def test_watch_seen(self):
+        status = self._get_documents(self._request(
+            '/dataset/changes', {'filters': {'servertype': 'test2'}}
+        ))[-1]
+        q = Query({'hostname': 'test1'})
+        q.get()['os'] = 'wheezy'
+        q.commit(user=User.objects.first())
+
+        # The response is returned without waiting for the newer commits.
+        documents = self._watch(
+            status['commit_id'], status['last_commit_id'], 60
+        )
+        self.assertEqual(
+            [d['hostname'] for d in documents[:-1]], ['test1']
+        )
+        self.assertGreater(
+            documents[-1]['last_commit_id'], status['last_commit_id']
+        )
+
+    def test_multi_query(self):
+        response = self._request('/dataset/multi_query', {'queries': [
+            {'filters': {'hostname': 'test0'}},
+            {'filters': {'nonexistent': 'test0'}},
+            {'filters': {'hostname': {'Regexp': '('}}},
+        ]})
+        results = self._get_documents(response)[0]['results']
+        self.assertEqual(
+            [r['status'] for r in results], ['success', 'error', 'error']
+        )
+        self.assertEqual(results[0]['result'][0]['hostname'], 'test0')
+
+
+class _TestServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class _TestHandler(BaseHTTPRequestHandler):
+    """Answer the requests with the responses of the test in order
+
+    The responses are tuples of the status, the headers and the body, or
+    functions to respond on the handler.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.server.requests.append((
+            self.command,
+            self.path,
+            self.headers,
+            self.rfile.read(length),
+            self.client_address,
+        ))
+        response = self.server.responses.pop(0)
+        if callable(response):
+            response(self)
+            return
+
+        status, headers, body = response
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ClientTestCase(SimpleTestCase):
+    """Run the client against a local server"""
+
+    def setUp(self):
+        self.server = _TestServer(('127.0.0.1', 0), _TestHandler)
+        self.server.requests = []
+        self.server.responses = []
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        base_url = 'http://127.0.0.1:{}/api'.format(self.server.server_port)
+        for target, name, value in (
+            (request.Settings, 'base_url', base_url),
+            (request.Settings, 'auth_token', 'test'),
+            (request.Settings, 'sleep_interval', 0),
+            (request.Settings, 'cache_dir', None),
+            (request, '_connection_pool', request.ConnectionPool()),
+            (request, '_response_cache', type(request._response_cache)()),
+        ):
+            patcher = mock.patch.object(target, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _respond(self, *responses):
+        self.server.responses.extend(responses)
+
+    def _respond_json(self, document, **headers):
+        headers['Content-Type'] = 'application/x-json'
+        self._respond((200, headers, json.dumps(document).encode()))
+
+
+class TestResponseCache(ClientTestCase):
+    def _query(self, cache_ttl):
+        return list(request.stream_request(
+            '/dataset/query', post_params={'filters': {}}, cache_ttl=cache_ttl
+        ))
+
+    def test_revalidate(self):
+        self._respond_json({'status': 'success'}, ETag='"1"')
+        self._respond((304, {'ETag': '"1"'}, b''))
+        self.assertEqual(self._query(0), [{'status': 'success'}])
+        self.assertEqual(self._query(0), [{'status': 'success'}])
+
+        headers = [r[2] for r in self.server.requests]
+        self.assertNotIn('If-None-Match', headers[0])
+        self.assertEqual(headers[1]['If-None-Match'], '"1"')
+
+    def test_ttl(self):
+        self._respond_json({'status': 'success'}, ETag='"1"')
+        self._query(60)
+        self.assertEqual(self._query(60), [{'status': 'success'}])
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_not_kept(self):
+        self._respond_json({'status': 'success'}, ETag='"1"')
+        self._query(None)
+        self.assertFalse(request._response_cache)
+
+        self._respond_json({'status': 'success'}, ETag='"1"')
+        with mock.patch.object(
+            request.Settings, 'max_cached_response_size', 10
+        ):
+            self._query(0)
+        self.assertFalse(request._response_cache)
+
+
+class TestDiskCache(TestResponseCache):
+    def setUp(self):
+        super(TestDiskCache, self).setUp()
+        cache_dir = TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        self.cache_dir = os.path.join(cache_dir.name, 'cache')
+        patcher = mock.patch.object(
+            request.Settings, 'cache_dir', self.cache_dir
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_ttl(self):
+        super(TestDiskCache, self).test_ttl()
+        self.assertFalse(request._response_cache)
+        self.assertEqual(os.stat(self.cache_dir).st_mode & 0o777, 0o700)
+
+    def test_not_kept(self):
+        self._respond_json({'status': 'success'}, ETag='"1"')
+        self._query(None)
+        self.assertFalse(os.path.exists(self.cache_dir))
+
+    def test_without_etag(self):
+        self._respond_json({'status': 'success'})
+        self._respond_json({'status': 'success'})
+        self._query(60)
+        self._query(60)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_other_key(self):
+        self._respond_json({'status': 'success', 'result': 1}, ETag='"1"')
+        self._respond_json({'status': 'success', 'result': 2}, ETag='"2"')
+        self._query(60)
+        documents = list(request.stream_request(
+            '/dataset/query',
+            post_params={'filters': {'hostname': 'test0'}},
+            cache_ttl=60,
+        ))
+        self.assertEqual(documents, [{'status': 'success', 'result': 2}])
+
+
+class TestSchema(ClientTestCase):
+    def setUp(self):
+        super(TestSchema, self).setUp()
+        patcher = mock.patch.object(schema, '_schemas', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_converters(self):
+        self._respond_json({'status': 'success', 'version': 1, 'attributes': {
+            'intern_ip': {'type': 'inet', 'multi': False},
+            'os': {'type': 'string', 'multi': False},
+            'built_on': {'type': 'date', 'multi': False},
+        }})
+        result = schema.get_schema()
+        self.assertEqual(result.version, 1)
+        self.assertEqual(
+            result.get_converter('intern_ip')('10.16.2.1'),
+            IPv4Address('10.16.2.1'),
+        )
+        self.assertIsNone(result.get_converter('intern_ip')(None))
+        # The strings are not sniffed by their formats anymore.
+        self.assertEqual(
+            result.get_converter('os')('10.16.2.1'), '10.16.2.1'
+        )
+        self.assertEqual(
+            result.get_converter('built_on')('2017-01-02'), date(2017, 1, 2)
+        )
+        self.assertEqual(
+            result.get_converter('unknown')('10.16.2.1'),
+            IPv4Address('10.16.2.1'),
+        )
+
+        self.assertIs(schema.get_schema(), result)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_expired(self):
+        for version in (1, 2):
+            self._respond_json(
+                {'status': 'success', 'version': version, 'attributes': {}}
+            )
+        schema.get_schema()
+        with mock.patch.object(request.Settings, 'schema_ttl', -1):
+            self.assertEqual(schema.get_schema().version, 2)
+
+    def test_unsupported(self):
+        self._respond((404, {}, b''))
+        result = schema.get_schema()
+        self.assertIsNone(result.version)
+        self.assertEqual(
+            result.get_converter('intern_ip')('10.16.2.1'),
+            IPv4Address('10.16.2.1'),
+        )
+        self.assertIs(schema.get_schema(), result)
+        self.assertEqual(len(self.server.requests), 1)
+
+
+def _close_connection(handler):
+    handler.close_connection = True
+
+
+class TestConnectionPool(ClientTestCase):
+    def _ports(self):
+        return [r[4][1] for r in self.server.requests]
+
+    def test_reuse(self):
+        self._respond_json({'status': 'success'})
+        self._respond_json({'status': 'success'})
+        request.send_request('/test')
+        request.send_request('/test')
+        ports = self._ports()
+        self.assertEqual(ports[0], ports[1])
+
+    def test_stale(self):
+        self._respond_json({'status': 'success'})
+        self._respond(_close_connection)
+        self._respond_json({'status': 'success', 'result': 1})
+        request.send_request('/test')
+        self.assertEqual(request.send_request('/test')['result'], 1)
+        ports = self._ports()
+        self.assertEqual(len(ports), 3)
+        self.assertEqual(ports[0], ports[1])
+        self.assertNotEqual(ports[1], ports[2])
+
+    def test_timeout(self):
+        self._respond_json({'status': 'success'})
+        self._respond(lambda handler: sleep(0.5))
+        with mock.patch.object(request.Settings, 'timeout', 0.1):
+            request.send_request('/test')
+            with self.assertRaises(socket.timeout):
+                request.send_request('/test')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_server_error(self):
+        self._respond((503, {}, b''))
+        self._respond_json({'status': 'success'})
+        self.assertEqual(request.send_request('/test')['status'], 'success')
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_retry_interval(self):
+        for attempt in range(10):
+            interval = request.get_retry_interval(attempt)
+            self.assertGreaterEqual(interval, 0)
+            self.assertLessEqual(
+                interval,
+                min(
+                    request.Settings.sleep_interval * 2 ** attempt,
+                    request.Settings.max_sleep_interval,
+                ),
+            )
+
+
+class TestRedirect(ClientTestCase):
+    def test_temporary(self):
+        self._respond((307, {'Location': '/api/other'}, b''))
+        self._respond_json({'status': 'success'})
+        request.send_request('/test', post_params={'test': 1})
+        (method0, path0, _, body0, _), (method1, path1, _, body1, _) = (
+            self.server.requests
+        )
+        self.assertEqual((method1, path1), ('POST', '/api/other'))
+        self.assertEqual(body0, body1)
+
+    def test_see_other(self):
+        self._respond((303, {'Location': 'other'}, b''))
+        self._respond_json({'status': 'success'})
+        request.send_request('/test', post_params={'test': 1})
+        method, path, _, body, _ = self.server.requests[1]
+        self.assertEqual((method, path, body), ('GET', '/api/other', b''))
+
+    def test_without_location(self):
+        self._respond((302, {}, b''))
+        with self.assertRaises(request.HTTPError):
+            request.send_request('/test')
+
+    def test_too_many(self):
+        with mock.patch.object(request.Settings, 'max_redirects', 1):
+            self._respond((302, {'Location': '/api/test'}, b''))
+            self._respond((302, {'Location': '/api/test'}, b''))
+            with self.assertRaises(request.HTTPError):
+                request.send_request('/test')
+        self.assertEqual(len(self.server.requests), 2)
+
+
+@skipIf(
+    sys.version_info < (3, 5, 2), 'The asyncio client requires Python 3.5.2'
+)
+class TestAsyncClient(ClientTestCase):
+    def setUp(self):
+        super(TestAsyncClient, self).setUp()
+        # The module cannot even be compiled on the older versions.
+        from adminapi import aio
+        self.aio = aio
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+        self.addCleanup(asyncio.set_event_loop, None)
+
+        patcher = mock.patch.object(schema, '_schemas', {})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _send_requests(self, count):
+        return [
+            self.loop.run_until_complete(self.aio.send_request('/test'))
+            for i in range(count)
+        ]
+
+    def test_iterate(self):
+        self._respond_json({'status': 'success', 'result': [
+            {'object_id': 1, 'hostname': 'test0'},
+        ]})
+        self._respond((404, {}, b''))
+        iterator = self.aio.AsyncQuery({'hostname': 'test0'}).__aiter__()
+        server = self.loop.run_until_complete(iterator.__anext__())
+        self.assertEqual(server['hostname'], 'test0')
+        with self.assertRaises(StopAsyncIteration):
+            self.loop.run_until_complete(iterator.__anext__())
+
+    def test_stale(self):
+        self._respond_json({'status': 'success'})
+        self._respond(_close_connection)
+        self._respond_json({'status': 'success', 'result': 1})
+        self.assertEqual(self._send_requests(2)[1]['result'], 1)
+        ports = [r[4][1] for r in self.server.requests]
+        self.assertEqual(len(ports), 3)
+        self.assertEqual(ports[0], ports[1])
+        self.assertNotEqual(ports[1], ports[2])
+
+    def test_timeout(self):
+        self._respond_json({'status': 'success'})
+        self._respond(lambda handler: sleep(0.5))
+        with mock.patch.object(request.Settings, 'timeout', 0.1):
+            with self.assertRaises(asyncio.TimeoutError):
+                self._send_requests(2)
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_redirect(self):
+        self._respond((302, {'Location': '/api/other'}, b''))
+        self._respond_json({'status': 'success'})
+        self.assertEqual(self._send_requests(1)[0]['status'], 'success')
+        self.assertEqual(self.server.requests[1][1], '/api/other')
+
+    def test_not_modified(self):
+        self._respond((304, {}, b''))
+        with self.assertRaises(request.HTTPError):
+            self._send_requests(1)